@@ -1,89 +1,328 @@
 # The functions for getting song information from an image
 import numpy as np
 import cv2
-import pytesseract
 
-import sys
-import datetime
+import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from song_info import SongInfo
-from functions import fetchRanks, fetchNoteTypes, fetchDifficulties, fetchScoreIcon, fetchMaxCombo, fetchFastSlow, rescaleImage
-from consts import ranks, maxComboDim, ENABLE_LOGGING
+from ocr import MeteredBackend, createBackend
+from matching import Frame, LayoutCache, asFrame, matchBest, matchRegion, verifyMatch, windowBounds
+from templates import loadTemplates, rankGlyph
+from digits import DigitRecognizer
+from functions import rescaleImage, thresholdAdaptive, thresholdFixed, songInfoToStr, validateSong, getDifficulty
+from metrics import metrics
+from title_index import TitleIndex, titleFingerprint
+from capture import captureWriter
+from consts import types, difficultyColors, maxComboDim, searchWindows, MATCH_THRESHOLD, ENABLE_LOGGING, BATCH_GAP, DIGIT_CONFIDENCE, DIGIT_RECOGNIZER, THRESHOLD_VARIANTS, BINARY_THRESHOLD, STAGE_THREADS, DIFFICULTY_CONFIDENCE, BADGE_MIN_SATURATION, BADGE_MIN_VALUE, NOTE_ROW_RADIUS, LAYOUT_RADIUS, RANK_BADGE_THRESHOLD
+
+# The OpenCV hue (0 to 180) of the badge color of each difficulty
+difficultyHues = { difficulty: int(cv2.cvtColor(np.uint8([[[int(color[5:7], 16), int(color[3:5], 16), int(color[1:3], 16)]]]), cv2.COLOR_BGR2HSV)[0, 0, 0]) for difficulty, color in difficultyColors.items() }
 
 def writeData(img, prefix, res='', path='data', ext='tif'):
+  '''Queues an image and its OCR result to be written to testdata by the background capture writer'''
   if ENABLE_LOGGING:
-    path = f"{sys.path[0]} + /../testdata/{path}/{prefix}-{str(datetime.datetime.now()).split('.')[0].replace(':', '-')}"
-    cv2.imwrite(f'{path}.{ext}', img)
-    try:
-      with open(f'{path}.gt.txt', 'w') as f:
-        f.write(str(res))
-    except:
-      pass
+    with metrics.timer('writeData'):
+      captureWriter().submit(img, prefix, res, path, ext)
+
+@contextmanager
+def stage(frame, name):
+  '''Adds the time spent in the block to the timings of a stage of the frame and to the metrics'''
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    frame.timings[name] += elapsed
+    metrics.record(f'stage {name}', elapsed)
+
+def parseNumber(data, default):
+  '''Parses a number read by OCR, returning the default if it is not a number'''
+  data = data.strip()
+  return int(data) if data.isdecimal() else default
+
+def parseScore(data):
+  '''Parses the score and high score read by OCR'''
+  lines = data.strip().splitlines()
+
+  # If there are no scores, return a negative result
+  if len(lines) == 0:
+    return (-1, -1)
+  
+  # Get the score and high score
+  score = lines[0].split(" ")[-1].strip()
+  highScore = lines[1].split(" ")[-1].strip() if len(lines) > 1 else "0"
+
+  # Return integer values of the scores, defaulting to 0 if the score is not a number
+  return (parseNumber(score, 0), parseNumber(highScore, 0))
+
+def composePage(rois, gap=BATCH_GAP):
+  '''Stacks the OCR ROIs into a single page separated by blank bands
+  \nReturns the page and the vertical band that each ROI occupies on the page'''
+  width = max(roi.shape[1] for roi in rois) + 2 * gap
+  height = sum(roi.shape[0] for roi in rois) + gap * (len(rois) + 1)
+  page = np.full((height, width), 255, np.uint8)
+
+  bands = []
+  y = gap
+  for roi in rois:
+    h, w = roi.shape[:2]
+    if roi.size > 0:
+      # Make every ROI dark text on a white background like the rest of the page
+      border = np.concatenate((roi[0], roi[-1], roi[:, 0], roi[:, -1]))
+      page[y:y+h, gap:gap+w] = 255 - roi if np.median(border) < 128 else roi
+    bands.append((y, y+h))
+    y += h + gap
+  return page, bands
+
+def splitPage(data, bands, gap=BATCH_GAP):
+  '''Maps the words read from a composite page back to the band of the ROI they were in
+  \nReturns the text of each band with one line per line read, like image_to_string'''
+  lines = [defaultdict(list) for _ in bands]
+  for i, word in enumerate(data['text']):
+    if not word.strip():
+      continue
+    # Find the band that the center of the word is in, splitting the gaps between bands in half
+    center = data['top'][i] + data['height'][i] / 2
+    band = next((x for x, (top, bottom) in enumerate(bands) if top - gap / 2 <= center < bottom + gap / 2), None)
+    if band is not None:
+      lines[band][(data['block_num'][i], data['par_num'][i], data['line_num'][i])].append(word.strip())
+  return ['\n'.join(' '.join(words) for words in band.values()) for band in lines]
 
 class ScoreAPI:
   '''ScoreAPI class so that templates only need to be initialized once'''
-  def __init__(self,  mode='cropped', draw=False):
+  def __init__(self,  mode='cropped', draw=False, batchOCR=False, ocr=None, matcher='pyramid', tiered=False, songData=None, parallel=False, titles: TitleIndex = None, digits=DIGIT_RECOGNIZER):
     self.mode = mode
     self.draw = draw
-    self.templates = {
-      'ranks': fetchRanks(mode),
-      'noteTypes': fetchNoteTypes(mode),
-      'difficulties': fetchDifficulties(mode),
-      'scoreIcon': fetchScoreIcon(mode),
-      'maxCombo': fetchMaxCombo(mode),
-      'fastSlow': fetchFastSlow(mode)
-    }
+    # Either 'pyramid' to match templates coarse to fine, 'exhaustive' to match them at full scale only,
+    # or 'spectral' to match the templates of a group against one transform of the frame
+    self.matcher = matcher
+    # The OCR backend used to read the ROIs, timing every call
+    self.ocr = MeteredBackend(ocr if ocr is not None else createBackend())
+    # The recognizer used for the numeric fields before falling back to Tesseract, disabled unless asked for since there are no digit templates by default
+    self.digits = DigitRecognizer() if digits else DigitRecognizer(None)
+    if digits and not self.digits.enabled:
+      logging.warning('ScoreAPI: The digit templates are missing, reading the numbers with Tesseract only')
+    # Whether to read the fields of an image from composite pages, see getSongInfoBatched
+    self.batchOCR = batchOCR
+    # Whether to read the fields with the cheap recognizers first, see getSongInfoTiered
+    self.tiered = tiered
+    # Optional function from a song name to its Bestdori song data, for checking the results of the tiered pipeline
+    self.songData = songData
+    # Whether to run the independent stages of a screenshot concurrently, see getSongInfoParallel
+    self.parallel = parallel
+    self.executor = ThreadPoolExecutor(STAGE_THREADS) if parallel else None
+    # Optional index of known song titles, so that they are not read with Tesseract
+    self.titles = titles
+    # Where the templates were found for each screenshot resolution
+    self.layouts = LayoutCache()
+    # Load the templates from the compiled bundle if there is one
+    self.templates = loadTemplates(mode)
+
+  def templateGroups(self):
+    '''Gets the groups of templates that are matched together as (name, templates, search window name)'''
+    groups = [
+      ('difficultyBadge', [self.templates['difficultyBadge']], 'difficulties'),
+      ('difficulties', [template for template, _ in self.templates['difficulties']], 'difficulties'),
+      ('rankBadge', [self.templates['rankBadge']], 'ranks'),
+      ('ranks', [template for template, _ in self.templates['ranks']], 'ranks'),
+      ('scoreIcon', [self.templates['scoreIcon']], 'scoreIcon'),
+      ('maxCombo', list(self.templates['maxCombo']), 'maxCombo'),
+    ]
+    groups += [(f'fastSlow-{x}', [template], 'fastSlow') for x, template in enumerate(self.templates['fastSlow'])]
+    groups += [(f'note-{type}', [template for template, _ in value], 'noteTypes') for type, value in self.templates['noteTypes'].items()]
+    return groups
+
+  def locate(self, frame, templates, window, name=None, fixed=True, threshold=MATCH_THRESHOLD, binary=False):
+    '''Locates the template that best matches the frame inside the search window of the given name, checking the cached location of a named group first
+    \nReturns the index of the template, its score and the (x, y) location of its match'''
+    start = time.perf_counter()
+    cache = name is not None and frame.resolution is not None
+    if cache:
+      anchor = self.layouts.get(frame.resolution, name)
+      match = verifyMatch(frame, templates, anchor, fixed, threshold=threshold, binary=binary) if anchor is not None else None
+      if match is not None:
+        frame.scores[name] = match[1]
+        metrics.count('layout hit')
+        metrics.record(f'match {name or window}', time.perf_counter() - start)
+        return match
+      metrics.count('layout miss')
+
+    if binary:
+      results = [matchRegion(frame.binary, template.image, windowBounds(frame.gray, searchWindows[window], template)) for template in templates]
+      index = max(range(len(results)), key=lambda x: results[x][0])
+      match = (index, *results[index])
+    else:
+      match = matchBest(frame, templates, searchWindows[window], threshold, pyramid=self.matcher == 'pyramid', spectral=self.matcher == 'spectral')
+    if cache and match[1] >= threshold:
+      self.layouts.set(frame.resolution, name, match[0], match[2])
+    metrics.record(f'match {name or window}', time.perf_counter() - start)
+    frame.scores[name or window] = match[1]
+    return match
+
+  def drawBox(self, frame, tl, br):
+    '''Draws a bounding box on the frame if draw is enabled, or queues it if the frame defers its annotations'''
+    if not self.draw:
+      return
+    if frame.annotations is not None:
+      frame.annotations.append((tl, br))
+    else:
+      cv2.rectangle(frame.image, tl, br, (0, 0, 255), 1)
+
+  def readNumber(self, ROI):
+    '''Reads a number from a ROI with the digit recognizer if it is enabled, only using Tesseract if the digit recognizer is not confident'''
+    if not self.digits.enabled:
+      return self.ocr.imageToString(ROI, "--psm 7 digits")
+    value, confidence = self.digits.recognize(ROI)
+    if value is not None and confidence >= DIGIT_CONFIDENCE:
+      metrics.count('digits hit')
+      return str(value)
+    metrics.count('digits miss')
+    return self.ocr.imageToString(ROI, "--psm 7 digits")
+
+  def readScore(self, ROI):
+    '''Reads the score and high score lines from a ROI with the digit recognizer if it is enabled, only using Tesseract if the digit recognizer is not confident'''
+    if not self.digits.enabled:
+      return self.ocr.imageToString(ROI, "--psm 6")
+    lines = self.digits.recognizeLines(ROI)
+    if 0 < len(lines) <= 2 and all(value is not None and confidence >= DIGIT_CONFIDENCE for value, confidence in lines):
+      metrics.count('digits hit')
+      return '\n'.join(str(value) for value, _ in lines)
+    metrics.count('digits miss')
+    return self.ocr.imageToString(ROI, "--psm 6")
+
+  def classifyRank(self, frame, location, shape):
+    '''Classifies the rank badge at a location by its binarized glyph, checking the best rank by matching its template around the glyph
+    \nReturns the index of the rank, its match score and the (x, y) location of its match, or None if there is no glyph'''
+    x, y = location
+    h, w = shape[:2]
+    height, width = frame.shape[:2]
+    # Leave a margin around the badge, since the glyphs of the ranks are narrower than the badge and may not be centered in it
+    m = w // 4
+    left, top = max(0, x - m), max(0, y - m)
+    glyph = rankGlyph(frame.gray[top:min(height, y+h+m), left:min(width, x+w+m)])
+    if glyph is None:
+      return None
+    descriptor, (gx, gy, gw, gh) = glyph
+    index = int(np.argmax(self.templates['rankGlyphs'] @ descriptor))
+
+    # Search for the template of the rank around the center of the glyph
+    template = self.templates['ranks'][index][0]
+    th, tw = template.shape[:2]
+    tx, ty = left + gx + (gw - tw) // 2, top + gy + (gh - th) // 2
+    r = LAYOUT_RADIUS * 2
+    bounds = (max(0, tx - r), max(0, ty - r), min(width, tx + tw + r), min(height, ty + th + r))
+    if bounds[2] - bounds[0] < tw or bounds[3] - bounds[1] < th:
+      return None
+    score, location = matchRegion(frame.gray, template.image, bounds)
+    return index, score, location
 
   def getRank(self, image):
     '''Gets the rank of the image result'''
-    # Try all the ranks and get the best match
-    results = [(cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED), rank) for template, rank in self.templates['ranks']]
-    # Get the rank of the best match
-    result, rank = max(results, key=lambda x: x[0].max())
+    frame = asFrame(image)
+    # Find the rank badge on the black and white frame, which does not depend on the background around the badge, and classify its glyph
+    badge = self.templates['rankBadge']
+    _, score, location = self.locate(frame, [badge], 'ranks', 'rankBadge', threshold=RANK_BADGE_THRESHOLD, binary=True)
+    match = self.classifyRank(frame, location, badge.shape) if score >= RANK_BADGE_THRESHOLD else None
+    if match is not None and match[1] >= MATCH_THRESHOLD:
+      index, frame.scores['ranks'], (x, y) = match
+    else:
+      # Try all the ranks and get the best match
+      metrics.count('rank fallback')
+      index, _, (x, y) = self.locate(frame, [template for template, _ in self.templates['ranks']], 'ranks', 'ranks', fixed=False)
+    template, rank = self.templates['ranks'][index]
 
     # Draw the rectangle of the bounding box if draw is enabled
-    if self.draw:
-      h, w, _ = self.templates['ranks'][ranks.index(rank)][0].shape
-      y, x = np.unravel_index(np.argmax(result), result.shape)
-      cv2.rectangle(image, (x-1, y-1), (x+w+1, y+h+1), (0, 0, 255), 1)
+    h, w = template.shape[:2]
+    self.drawBox(frame, (x-1, y-1), (x+w+1, y+h+1))
 
     return rank
 
-  def getNotes(self, image):
-    '''Gets the different note counts of the image result'''
-    noteScores = {}
-
-    for type, value in self.templates['noteTypes'].items():
-      results = [(cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED), x) for x, template in enumerate([v[0] for v in value])]
-      result, index = max(results, key=lambda x: x[0].max())
-
-      # Get the note type and the variables for OCR
-      tmp, noteType = value[index]
+  def noteRows(self, frame):
+    '''Finds the labels of the note types from the Perfect and Miss labels, checking the rows in between where their spacing puts them
+    \nReturns the template, note type and (x, y) location of the label of each note type, or None if a label is not found'''
+    labels = self.templates['noteTypes']
+    index, score, (x, y) = self.locate(frame, [template for template, _ in labels['Perfect']], 'noteTypes', 'note-Perfect', fixed=False)
+    if score < MATCH_THRESHOLD or any(index >= len(labels.get(type, [])) for type in types):
+      return None
+    height, width = frame.shape[:2]
+    h, w = labels['Perfect'][index][0].shape[:2]
+    r = NOTE_ROW_RADIUS
+
+    # Search the column below the Perfect label for the Miss label, which is the last row
+    miss = labels['Miss'][index][0]
+    bounds = (max(0, x - r), y + h, min(width, x + w + r), height)
+    if bounds[2] - bounds[0] < miss.shape[1] or bounds[3] - bounds[1] < miss.shape[0]:
+      return None
+    score, location = matchRegion(frame.gray, miss.image, bounds)
+    if score < MATCH_THRESHOLD:
+      return None
+
+    # The centers of the rows are spaced evenly between the Perfect and Miss labels
+    top, bottom = y + h / 2, location[1] + miss.shape[0] / 2
+    pitch = (bottom - top) / (len(types) - 1)
+    rows = { 'Perfect': (*labels['Perfect'][index], (x, y)), 'Miss': (*labels['Miss'][index], location) }
+    for row, type in enumerate(types[1:-1], 1):
+      template, noteType = labels[type][index]
+      th, tw = template.shape[:2]
+      ty = int(round(top + row * pitch - th / 2))
+      bounds = (max(0, x - r), max(0, ty - r), min(width, x + w + r), min(height, ty + th + r))
+      if bounds[2] - bounds[0] < tw or bounds[3] - bounds[1] < th:
+        return None
+      score, location = matchRegion(frame.gray, template.image, bounds)
+      if score < MATCH_THRESHOLD:
+        return None
+      rows[type] = (template, noteType, location)
+    return { type: rows[type] for type in types }
+
+  def noteROIs(self, image):
+    '''Gets the OCR ROIs of the different note counts of the image result'''
+    frame = asFrame(image)
+    rois = {}
+
+    with metrics.timer('match noteRows'):
+      rows = self.noteRows(frame)
+    if rows is None:
+      # Search for each label on its own if the column is not found
+      metrics.count('notes fallback')
+      rows = {}
+      for type, value in self.templates['noteTypes'].items():
+        index, _, location = self.locate(frame, [v[0] for v in value], 'noteTypes', f'note-{type}')
+        rows[type] = (*value[index], location)
+
+    for type, (tmp, noteType, (x, y)) in rows.items():
+      # Get the variables for OCR
       ratio = noteType['ratio']
       tolerance = noteType['tolerance']
 
       # Get the location of the note type row
-      h, w, _ = tmp.shape
-      y, x = np.unravel_index(np.argmax(result), result.shape)
+      h, w = tmp.shape[:2]
 
       # Get the bounding box where the score of the note type is
       tl_x, tl_y = x+w+20, y-6+tolerance[0]
       br_x, br_y = x+int(w*ratio), y+h+tolerance[1]
 
       # Draw the rectangle of the bounding box if draw is enabled
-      if self.draw:
-        cv2.rectangle(image, (tl_x-1, tl_y-1), (br_x+1, br_y+1), (0, 0, 255), 1)
+      self.drawBox(frame, (tl_x-1, tl_y-1), (br_x+1, br_y+1))
 
       # Make image black and white for OCR
-      crop = image[tl_y:br_y, tl_x:br_x]
-      image_gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
-      blackAndWhiteImage = cv2.adaptiveThreshold(image_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,\
-            cv2.THRESH_BINARY, 9, 2)
+      crop = frame.gray[tl_y:br_y, tl_x:br_x]
+      blackAndWhiteImage = frame.binary[tl_y:br_y, tl_x:br_x]
+      rois[type] = (blackAndWhiteImage, crop)
+
+    return rois
+
+  def getNotes(self, image):
+    '''Gets the different note counts of the image result'''
+    noteScores = {}
 
+    for type, (ROI, crop) in self.noteROIs(image).items():
       # Read the score of the note type from the image
-      ROI = blackAndWhiteImage
-      data = pytesseract.image_to_string(ROI, config="--psm 7 digits")
-      res = int(data.strip()) if data.strip().isdecimal() else -1
+      data = self.readNumber(ROI)
+      res = parseNumber(data, -1)
       noteScores[type] = res
 
       # Write the data to testdata
@@ -92,74 +331,101 @@ class ScoreAPI:
     # Return the note type scores in a map
     return noteScores
 
-  def getScore(self, image):
-    '''Gets the score and high score of the image result'''
+  def scoreROI(self, image):
+    '''Gets the OCR ROI of the score and high score of the image result'''
+    frame = asFrame(image)
     # Get the location of the score icon
-    result = cv2.matchTemplate(image, self.templates['scoreIcon'], cv2.TM_CCOEFF_NORMED)
-    h, w, _ = self.templates['scoreIcon'].shape
-    y, x = np.unravel_index(np.argmax(result), result.shape)
+    _, _, (x, y) = self.locate(frame, [self.templates['scoreIcon']], 'scoreIcon', 'scoreIcon')
+    h, w = self.templates['scoreIcon'].shape[:2]
 
     # Use location of line separator to get the bounding box of the score
     tl_x, tl_y = x+w+5, y-10
     br_x, br_y = x+w+625, y+h+60
 
     # Draw the rectangle of the bounding box if draw is enabled
-    if self.draw:
-      cv2.rectangle(image, (tl_x-1, tl_y-1), (br_x+1, br_y+1), (0, 0, 255), 1)
+    self.drawBox(frame, (tl_x-1, tl_y-1), (br_x+1, br_y+1))
 
     # Make image black and white for OCR
-    crop = image[tl_y:br_y, tl_x:br_x]
-    image_gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
-    blackAndWhiteImage = cv2.adaptiveThreshold(image_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,\
-          cv2.THRESH_BINARY, 9, 2)
+    crop = frame.gray[tl_y:br_y, tl_x:br_x]
+    blackAndWhiteImage = frame.binary[tl_y:br_y, tl_x:br_x]
+    return blackAndWhiteImage, crop
+
+  def getScore(self, image):
+    '''Gets the score and high score of the image result'''
+    ROI, crop = self.scoreROI(image)
 
     # Read the score text from the image
-    ROI = blackAndWhiteImage
-    data = pytesseract.image_to_string(ROI, config="--psm 6")
+    data = self.readScore(ROI)
 
     # Write the data to testdata
     writeData(crop, f'Score', data)
 
-    lines = data.strip().splitlines()
-
-    # If there are no scores, return a negative result
-    if len(lines) == 0:
-      return (-1, -1)
-    
-    # Get the score and high score
-    score = lines[0].split(" ")[-1].strip()
-    highScore = lines[1].split(" ")[-1].strip() if len(lines) > 1 else "0"
-
-    # Return integer values of the scores, defaulting to 0 if the score is not a number
-    return (int(score) if score.isdecimal() else 0, int(highScore) if highScore.isdecimal() else 0)
-
-  def getSong(self, image):
-    '''Gets the song and difficulty level of the image result'''
-    # Try all the ranks and get the best match
-    results = [(cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED), difficulty) for template, difficulty in self.templates['difficulties']]
-    # Get the result and difficulty of the best match
-    result, difficulty = max(results, key=lambda x: x[0].max())
-
-    # Get the location of the difficulty
-    h, w, _ = self.templates['difficulties'][0][0].shape
-    y, x = np.unravel_index(np.argmax(result), result.shape)
+    return parseScore(data)
+
+  def classifyDifficulty(self, frame, location, shape):
+    '''Classifies the difficulty badge at a location by the hue of its colored pixels
+    \nReturns the difficulty whose badge hue is closest to most of the pixels, and the share of the pixels closest to it'''
+    x, y = location
+    h, w = shape[:2]
+    # Stay away from the edges of the badge, where the background and annotations are
+    m = max(2, h // 8)
+    hsv = cv2.cvtColor(frame.image[y+m:y+h-m, x+m:x+w-m], cv2.COLOR_BGR2HSV).reshape(-1, 3)
+    hues = hsv[(hsv[:, 1] >= BADGE_MIN_SATURATION) & (hsv[:, 2] >= BADGE_MIN_VALUE), 0].astype(np.int16)
+    # Most of the badge is its color, the rest is the white text
+    if len(hues) < len(hsv) / 3:
+      return None, 0.0
+
+    names = list(difficultyHues)
+    distance = np.abs(hues[:, None] - np.array([difficultyHues[name] for name in names])[None])
+    votes = np.bincount(np.minimum(distance, 180 - distance).argmin(axis=1), minlength=len(names))
+    return names[int(votes.argmax())], float(votes.max() / len(hues))
+
+  def songROI(self, image):
+    '''Gets the difficulty level and the OCR ROI of the song name of the image result'''
+    frame = asFrame(image)
+    # Find the difficulty badge and classify it by its color
+    badge = self.templates['difficultyBadge']
+    _, score, (x, y) = self.locate(frame, [badge], 'difficulties', 'difficultyBadge')
+    difficulty, confidence = self.classifyDifficulty(frame, (x, y), badge.shape) if score >= MATCH_THRESHOLD else (None, 0.0)
+    if confidence < DIFFICULTY_CONFIDENCE:
+      # Try all the difficulties and get the location and difficulty of the best match
+      metrics.count('difficulty fallback')
+      index, _, (x, y) = self.locate(frame, [template for template, _ in self.templates['difficulties']], 'difficulties', 'difficulties', fixed=False)
+      difficulty = self.templates['difficulties'][index][1]
+    h, w = self.templates['difficulties'][0][0].shape[:2]
 
     # Make a bounding box right of the difficulty for the song name
     tl_x, tl_y = x+w+10, y
     br_x, br_y = x+w+825, y+h
 
     # Draw the rectangle of the bounding box if draw is enabled
-    if self.draw:
-      cv2.rectangle(image, (tl_x-1, tl_y-1), (br_x+1, br_y+1), (0, 0, 255), 1)
+    self.drawBox(frame, (tl_x-1, tl_y-1), (br_x+1, br_y+1))
 
     # Make image black and white for OCR
-    crop = image[tl_y:br_y, tl_x:br_x]
-    image_gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
-    (_, blackAndWhiteImage) = cv2.threshold(image_gray, 150, 255, cv2.THRESH_BINARY)
+    crop = frame.gray[tl_y:br_y, tl_x:br_x]
+    blackAndWhiteImage = thresholdFixed(crop)
+    return blackAndWhiteImage, crop, difficulty
+
+  def readTitle(self, frame, ROI):
+    '''Reads the song name from the ROI of the title, looking its fingerprint up in the title index before using Tesseract
+    \nThe fingerprint and the key of the matched song are kept in the title of the frame'''
+    fingerprint = titleFingerprint(ROI) if self.titles is not None else None
+    match = self.titles.lookup(fingerprint) if fingerprint is not None else None
+    frame.title = { 'fingerprint': fingerprint, 'key': match[0] if match is not None else None }
+    if match is not None:
+      metrics.count('title index hit')
+      return match[1]
+    if self.titles is not None:
+      metrics.count('title index miss')
+    return self.ocr.imageToString(ROI, '--psm 7')
+
+  def getSong(self, image):
+    '''Gets the song and difficulty level of the image result'''
+    frame = asFrame(image)
+    ROI, crop, difficulty = self.songROI(frame)
 
     # Read the song name from the image
-    ROI = blackAndWhiteImage
-    data = pytesseract.image_to_string(ROI, config='--psm 7')
+    data = self.readTitle(frame, ROI)
 
     # Write the data to testdata
     writeData(crop, f'Song', data)
@@ -167,13 +433,12 @@ class ScoreAPI:
     # Return the song name and difficulty
     return (data.strip(), difficulty)
 
-  def getMaxCombo(self, image):
-    '''Gets the max combo of the image result'''
+  def maxComboROI(self, image):
+    '''Gets the OCR ROI of the max combo of the image result and which max combo template matched'''
+    frame = asFrame(image)
     # Get the location of the max combo icon
-    results = [(cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED), x) for x, template in enumerate(self.templates['maxCombo'])]
-    result, index = max(results, key=lambda x: x[0].max())
-    h, w, _ = self.templates['maxCombo'][index].shape
-    y, x = np.unravel_index(np.argmax(result), result.shape)
+    index, _, (x, y) = self.locate(frame, self.templates['maxCombo'], 'maxCombo', 'maxCombo')
+    h, w = self.templates['maxCombo'][index].shape[:2]
 
     dim = maxComboDim[index]
 
@@ -182,85 +447,317 @@ class ScoreAPI:
     br_x, br_y = x+w+dim[1][0], y+h+dim[1][1]
 
     # Draw the rectangle of the bounding box if draw is enabled
-    if self.draw:
-      cv2.rectangle(image, (tl_x-1, tl_y-1), (br_x+1, br_y+1), (0, 0, 255), 1)
+    self.drawBox(frame, (tl_x-1, tl_y-1), (br_x+1, br_y+1))
 
     # Make image black and white for OCR
-    crop = image[tl_y:br_y, tl_x:br_x]
-    image_gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
-    (_, blackAndWhiteImage) = cv2.threshold(image_gray, 150, 255, cv2.THRESH_BINARY)
+    crop = frame.gray[tl_y:br_y, tl_x:br_x]
+    blackAndWhiteImage = thresholdFixed(crop)
+    return blackAndWhiteImage, crop, index
+
+  def getMaxCombo(self, image):
+    '''Gets the max combo of the image result'''
+    ROI, crop, index = self.maxComboROI(image)
 
     # Read the max combo score from the image
-    ROI = blackAndWhiteImage
-    data = pytesseract.image_to_string(ROI, config="--psm 7 digits")
+    data = self.readNumber(ROI)
     data = data.strip()
 
     # Write the data to testdata
     writeData(crop, f'MaxCombo', data)
 
     # Return the max combo score, defaulting to 0 if the score is not a number
-    return int(data) if data.isdecimal() else 0, index == 1
+    return parseNumber(data, 0), index == 1
 
-  def getFastSlow(self, image):
-    '''Gets the fast and slow count of the image result'''
+  def fastSlowROIs(self, image):
+    '''Gets the OCR ROIs of the fast and slow count of the image result'''
+    frame = asFrame(image)
     # Iterates through the fast/slow tuple templates
-    res = []
-    results = [(cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED), x) for x, template in enumerate(self.templates['fastSlow'])]
-    for result, x in results:
-      h, w, _ = self.templates['fastSlow'][x].shape
-      y, x = np.unravel_index(np.argmax(result), result.shape)
+    rois = []
+    for i, template in enumerate(self.templates['fastSlow']):
+      _, _, (x, y) = self.locate(frame, [template], 'fastSlow', f'fastSlow-{i}')
+      h, w = template.shape[:2]
 
       # Get the bounding box where the fast/slow score is
       tl_x, tl_y = x+w, y-2
       br_x, br_y = x+(w*2), y+h
 
       # Draw the rectangle of the bounding box if draw is enabled
-      if self.draw:
-        cv2.rectangle(image, (tl_x-1, tl_y-1), (br_x+1, br_y+1), (0, 0, 255), 1)
+      self.drawBox(frame, (tl_x-1, tl_y-1), (br_x+1, br_y+1))
 
       # Make image black and white for OCR
-      crop = image[tl_y:br_y, tl_x:br_x]
-      image_gray = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
-      blackAndWhiteImage = cv2.adaptiveThreshold(image_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,\
-          cv2.THRESH_BINARY, 9, 2)
+      crop = frame.gray[tl_y:br_y, tl_x:br_x]
+      blackAndWhiteImage = frame.binary[tl_y:br_y, tl_x:br_x]
+      rois.append((blackAndWhiteImage, crop))
+
+    return rois
+
+  def getFastSlow(self, image):
+    '''Gets the fast and slow count of the image result'''
+    res = []
+    for ROI, crop in self.fastSlowROIs(image):
       # Read the fast/slow score from the image
-      ROI = blackAndWhiteImage
-      data = pytesseract.image_to_string(ROI, config="--psm 7 digits")
+      data = self.readNumber(ROI)
       data = data.strip()
 
       # Write the data to testdata
       writeData(crop, f'FastSlow', data)
 
-      res.append(int(data) if data.isdecimal() else -1)
+      res.append(parseNumber(data, -1))
 
     # Returns the result in a list. The list should be of the same length as the tuple of templates
     return res
 
-  def getSongInfo(self, image):
-    '''Gets the song information from an image'''
-    # Rescale the image according to its aspect ratio
-    img = rescaleImage(image)
-
-    # Get the song name and difficulty
-    song, difficulty = self.getSong(img)
-    # Get the score rank
-    rank = self.getRank(img)
-    # Get the score and high score
-    score, highScore = self.getScore(img)
-    # Get the max combo
-    maxCombo, fastSlow = self.getMaxCombo(img)
-    if fastSlow:
-      fast, slow = self.getFastSlow(img)
+  def readPage(self, rois, config, lines):
+    '''Reads ROIs from one composite page, checking that each band has the (min, max) number of lines expected of its ROI
+    \nReturns the text of each ROI, or None if a band read a different number of lines'''
+    page, bands = composePage(rois)
+    texts = splitPage(self.ocr.imageToData(page, config), bands)
+    if any(not low <= len(text.splitlines()) <= high for text, (low, high) in zip(texts, lines)):
+      metrics.count('batch fallback')
+      return None
+    return texts
+
+  def getSongInfoBatched(self, image):
+    '''Gets the song information from a rescaled image with one Tesseract call for the text fields and one for the numbers
+    \nA page that does not read one line per field, or up to two for the score, is read again one field at a time'''
+    frame = asFrame(image)
+    # Get the ROIs of all the fields, in the same order as getSongInfo
+    songROI, songCrop, difficulty = self.songROI(frame)
+    rank = self.getRank(frame)
+    scoreROI, scoreCrop = self.scoreROI(frame)
+    maxComboROI, maxComboCrop, index = self.maxComboROI(frame)
+    fastSlowROIs = self.fastSlowROIs(frame) if index == 1 else []
+    noteROIs = self.noteROIs(frame)
+
+    # Read the song name and score from one page, and the numbers from another with the digits config
+    texts = self.readPage([songROI, scoreROI], '--psm 6', [(1, 1), (1, 2)])
+    if texts is None:
+      texts = [self.readTitle(frame, songROI), self.readScore(scoreROI)]
+    numbers = [maxComboROI] + [roi for roi, _ in fastSlowROIs] + [roi for roi, _ in noteROIs.values()]
+    numberTexts = self.readPage(numbers, '--psm 6 digits', [(1, 1)] * len(numbers))
+    if numberTexts is None:
+      numberTexts = [self.readNumber(roi) for roi in numbers]
+    texts += numberTexts
+
+    # Map the text of each band back to its field
+    song = texts[0].strip()
+    writeData(songCrop, f'Song', texts[0])
+    score, highScore = parseScore(texts[1])
+    writeData(scoreCrop, f'Score', texts[1])
+    maxCombo = parseNumber(texts[2], 0)
+    writeData(maxComboCrop, f'MaxCombo', texts[2].strip())
+
+    fastSlow = []
+    for (_, crop), text in zip(fastSlowROIs, texts[3:3+len(fastSlowROIs)]):
+      writeData(crop, f'FastSlow', text.strip())
+      fastSlow.append(parseNumber(text, -1))
+    fast, slow = fastSlow if fastSlow else (-1, -1)
+
+    notes = {}
+    for (type, (_, crop)), text in zip(noteROIs.items(), texts[3+len(fastSlowROIs):]):
+      notes[type] = parseNumber(text, -1)
+      writeData(crop, f'Note-{type}', notes[type])
+
+    return SongInfo(song, difficulty, rank, score, highScore, maxCombo, notes, fast, slow)
+
+  def readVariants(self, ROI, crop, config, parse, threshold=BINARY_THRESHOLD):
+    '''Reads a ROI with Tesseract, then the adaptive threshold variants of its crop other than the ROI's own threshold until two of the reads agree
+    \nReturns the most common of the parsed reads, preferring the earliest on a tie'''
+    reads = [parse(self.ocr.imageToString(ROI, config))]
+    for blockSize, C in THRESHOLD_VARIANTS:
+      if (blockSize, C) == threshold:
+        continue
+      if len(reads) != len(set(reads)):
+        break
+      reads.append(parse(self.ocr.imageToString(thresholdAdaptive(crop, blockSize, C), config)))
+    return max(reads, key=reads.count)
+
+  def checkSongInfo(self, songInfo):
+    '''Checks the fields of a SongInfo against each other, and against the Bestdori song data if there is any
+    \nReturns the set of fields that failed a check'''
+    failed = set(f'notes.{type}' for type in types if songInfo.notes[type] < 0)
+    if songInfo.hasFastSlow() and songInfo.fast + songInfo.slow != songInfo.notes['Great'] + songInfo.notes['Good'] + songInfo.notes['Bad']:
+      failed |= { 'fast', 'slow', 'notes.Great', 'notes.Good', 'notes.Bad' }
+    if songInfo.maxCombo > songInfo.notes['Perfect'] + songInfo.notes['Great']:
+      failed |= { 'maxCombo', 'notes.Perfect', 'notes.Great' }
+
+    songData = self.songData(songInfo.songName) if self.songData is not None else None
+    if songData:
+      difficulty = str(getDifficulty(songInfo.difficulty))
+      if difficulty not in songData.get('notes', {}) or difficulty not in songData.get('difficulty', {}):
+        # The song has no chart of the difficulty that was read, so either the difficulty or the note counts are wrong
+        failed |= { 'difficulty' } | set(f'notes.{type}' for type in types)
+      else:
+        _, checks = validateSong(songInfo, songData)
+        if not checks['totalNotes']:
+          failed |= set(f'notes.{type}' for type in types)
+        if not checks['rank'] or not checks['impossibleScore']:
+          failed |= { 'score', 'rank' }
+    return failed
+
+  def getSongInfoTiered(self, frame):
+    '''Gets the song information from a rescaled image with the cheap recognizers first, only reading the fields that are not confident or fail checkSongInfo again
+    \nReturns the SongInfo and the confidence of each field'''
+    confidences = {}
+    def fastNumber(field, ROI, default):
+      if not self.digits.enabled:
+        # Without the digit templates, read the number once with Tesseract and only escalate it if it fails the checks
+        confidences[field] = 1.0
+        return parseNumber(self.ocr.imageToString(ROI, '--psm 7 digits'), default)
+      value, confidence = self.digits.recognize(ROI)
+      confidences[field] = confidence
+      return value if value is not None else default
+
+    # Fast tier: template matches and the digit recognizer, with Tesseract only for the song name
+    songROI, songCrop, difficulty = self.songROI(frame)
+    song = self.readTitle(frame, songROI).strip()
+    # The difficulty templates are only matched when the badge color is not confident
+    confidences['difficulty'] = frame.scores['difficulties'] if 'difficulties' in frame.scores else frame.scores['difficultyBadge']
+    rank = self.getRank(frame)
+    confidences['rank'] = frame.scores['ranks']
+
+    scoreROI, scoreCrop = self.scoreROI(frame)
+    lines = self.digits.recognizeLines(scoreROI) if self.digits.enabled else []
+    values = [value for value, _ in lines]
+    if not self.digits.enabled:
+      score, highScore = parseScore(self.ocr.imageToString(scoreROI, '--psm 6'))
+      confidences['score'] = confidences['highScore'] = 1.0
+    elif 0 < len(lines) <= 2 and None not in values:
+      # Like parseScore, a missing high score is 0
+      score, highScore = (values + [0])[:2]
+      confidences['score'] = confidences['highScore'] = min(confidence for _, confidence in lines)
     else:
-      fast, slow = -1, -1
-    # Get the note type scores
-    notes = self.getNotes(img)
+      score, highScore = -1, -1
+      confidences['score'] = confidences['highScore'] = 0.0
+
+    maxComboROI, maxComboCrop, index = self.maxComboROI(frame)
+    maxCombo = fastNumber('maxCombo', maxComboROI, 0)
+    fastSlowROIs = self.fastSlowROIs(frame) if index == 1 else []
+    fastSlow = [fastNumber(field, ROI, -1) for field, (ROI, _) in zip(['fast', 'slow'], fastSlowROIs)]
+    fast, slow = fastSlow if fastSlow else (-1, -1)
+    noteROIs = self.noteROIs(frame)
+    notes = { type: fastNumber(f'notes.{type}', ROI, -1) for type, (ROI, _) in noteROIs.items() }
+    songInfo = SongInfo(song, difficulty, rank, score, highScore, maxCombo, notes, fast, slow)
 
-    # Write the data to testdata
-    writeData(img, f'SongInfo', path='songs', ext='png')
+    # Slow tier: read the fields that failed again
+    escalate = set(field for field, confidence in confidences.items() if confidence < (MATCH_THRESHOLD if field in ['difficulty', 'rank'] else DIGIT_CONFIDENCE))
+    escalate |= self.checkSongInfo(songInfo)
+    for field in escalate:
+      metrics.count(f'escalated {field}')
+
+    if 'difficulty' in escalate:
+      templates = [template for template, _ in self.templates['difficulties']]
+      songInfo.difficulty = self.templates['difficulties'][matchBest(frame, templates)[0]][1]
+    if 'rank' in escalate:
+      templates = [template for template, _ in self.templates['ranks']]
+      songInfo.rank = self.templates['ranks'][matchBest(frame, templates)[0]][1]
+    if 'score' in escalate or 'highScore' in escalate:
+      songInfo.score, songInfo.highScore = self.readVariants(scoreROI, scoreCrop, '--psm 6', parseScore)
+    if 'maxCombo' in escalate:
+      songInfo.maxCombo = self.readVariants(maxComboROI, maxComboCrop, '--psm 7 digits', lambda data: parseNumber(data, 0), threshold=None)
+    for field, (ROI, crop) in zip(['fast', 'slow'], fastSlowROIs):
+      if field in escalate:
+        setattr(songInfo, field, self.readVariants(ROI, crop, '--psm 7 digits', lambda data: parseNumber(data, -1)))
+    for type, (ROI, crop) in noteROIs.items():
+      if f'notes.{type}' in escalate:
+        songInfo.notes[type] = self.readVariants(ROI, crop, '--psm 7 digits', lambda data: parseNumber(data, -1))
+
+    # Write the data to testdata with the final values
+    writeData(songCrop, f'Song', song)
+    writeData(scoreCrop, f'Score', f'{songInfo.score}\n{songInfo.highScore}')
+    writeData(maxComboCrop, f'MaxCombo', songInfo.maxCombo)
+    for field, (_, crop) in zip(['fast', 'slow'], fastSlowROIs):
+      writeData(crop, f'FastSlow', getattr(songInfo, field))
+    for type, (_, crop) in noteROIs.items():
+      writeData(crop, f'Note-{type}', songInfo.notes[type])
+
+    return songInfo, confidences
+
+  def getSongInfoParallel(self, frame):
+    '''Gets the song information from a rescaled image, running the independent stages on the thread pool
+    \nThe annotations are drawn in a sorted order once every stage is done, so the image is the same on every run'''
+    # Compute the shared copies of the frame once, before the stages race to do it
+    frame.binary, frame.small
+    frame.annotations = []
+
+    def submit(name, fn):
+      def run():
+        with stage(frame, name):
+          return fn(frame)
+      return self.executor.submit(run)
 
-    songInfo = SongInfo(song, difficulty, rank, score, highScore, maxCombo, notes, fast, slow)
-    return songInfo, img
+    try:
+      song = submit('song', self.getSong)
+      rank = submit('rank', self.getRank)
+      score = submit('score', self.getScore)
+      maxCombo = submit('maxCombo', self.getMaxCombo)
+      notes = submit('notes', self.getNotes)
+
+      maxCombo, fastSlow = maxCombo.result()
+      with stage(frame, 'fastSlow'):
+        if fastSlow:
+          fast, slow = self.getFastSlow(frame)
+        else:
+          fast, slow = -1, -1
+      (song, difficulty), rank, (score, highScore), notes = song.result(), rank.result(), score.result(), notes.result()
+    finally:
+      annotations, frame.annotations = frame.annotations, None
+
+    for tl, br in sorted(annotations):
+      self.drawBox(frame, tl, br)
+    return SongInfo(song, difficulty, rank, score, highScore, maxCombo, notes, fast, slow)
+
+  def getSongInfo(self, image, timings=None, title=None, resolution=None):
+    '''Gets the song information from an image, filling the timings and title dicts if given
+    \nIf a resolution is given, the image was already rescaled by decodeImage'''
+    # Rescale the image according to its aspect ratio
+    start = time.perf_counter()
+    frame = Frame(rescaleImage(image), image.shape[:2]) if resolution is None else Frame(image, resolution)
+    frame.timings['rescale'] = time.perf_counter() - start
+    metrics.record('rescale', frame.timings['rescale'])
+
+    if self.batchOCR:
+      with stage(frame, 'batch'):
+        songInfo = self.getSongInfoBatched(frame)
+    elif self.tiered:
+      with stage(frame, 'tiered'):
+        songInfo, _ = self.getSongInfoTiered(frame)
+    elif self.parallel:
+      with stage(frame, 'parallel'):
+        songInfo = self.getSongInfoParallel(frame)
+    else:
+      # Get the song name and difficulty
+      with stage(frame, 'song'):
+        song, difficulty = self.getSong(frame)
+      # Get the score rank
+      with stage(frame, 'rank'):
+        rank = self.getRank(frame)
+      # Get the score and high score
+      with stage(frame, 'score'):
+        score, highScore = self.getScore(frame)
+      # Get the max combo
+      with stage(frame, 'maxCombo'):
+        maxCombo, fastSlow = self.getMaxCombo(frame)
+      with stage(frame, 'fastSlow'):
+        if fastSlow:
+          fast, slow = self.getFastSlow(frame)
+        else:
+          fast, slow = -1, -1
+      # Get the note type scores
+      with stage(frame, 'notes'):
+        notes = self.getNotes(frame)
+      songInfo = SongInfo(song, difficulty, rank, score, highScore, maxCombo, notes, fast, slow)
+
+    # Write the data to testdata, with the result as the ground truth for the stage benchmark once checked
+    with stage(frame, 'writeData'):
+      writeData(frame.image, f'SongInfo', songInfoToStr(songInfo), path='songs', ext='png')
+
+    metrics.count('images')
+    if timings is not None:
+      timings.update(frame.timings)
+    if title is not None and frame.title is not None:
+      title.update(frame.title)
+    return songInfo, frame.image
 
   def jsonOutput(self, image):
     '''Returns the result of the song information in a json format'''
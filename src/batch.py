@@ -0,0 +1,87 @@
+# Batch OCR of screenshot directories over multiple worker processes
+import os
+os.environ["OPENCV_LOG_LEVEL"]="SILENT"
+
+import numpy as np
+
+import argparse
+import glob
+import json
+import multiprocessing
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import ocr_pool
+from consts import OCR_WORKERS
+
+def listImages(path):
+  '''Lazily lists the images of a directory, or the files matching a glob'''
+  pattern = os.path.join(path, '*') if os.path.isdir(path) else path
+  for file in glob.iglob(pattern, recursive=True):
+    if os.path.splitext(file)[1].lower() in ['.jpg', '.jpeg', '.png']:
+      yield file
+
+def processImage(file):
+  '''Reads the song information of an image file in a worker process
+  \nReturns the JSON record of the image with the fields of the SongInfo and the milliseconds spent in each stage'''
+  try:
+    with open(file, 'rb') as f:
+      data = f.read()
+  except OSError as e:
+    return { 'file': file, 'error': str(e), 'timings': {} }
+  return { 'file': file, **ocr_pool.readImage(data) }
+
+def runBatch(path, output, workers=OCR_WORKERS, mode='cropped'):
+  '''Runs the OCR over the images of a path on worker processes, writing one JSON record per image to the output
+  \nOnly a few images per worker are in flight at once, so memory does not grow with the number of images'''
+  stages = defaultdict(list)
+  count, errors = 0, 0
+  start = time.perf_counter()
+
+  with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=ocr_pool.initWorker, initargs=(mode, False)) as executor:
+    files = listImages(path)
+    pending = set()
+    while True:
+      # Keep the workers busy without queueing every file up front
+      for file in files:
+        pending.add(executor.submit(processImage, file))
+        if len(pending) >= workers * 2:
+          break
+      if not pending:
+        break
+
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        record = future.result()
+        output.write(json.dumps(record) + '\n')
+        count += 1
+        errors += 'error' in record
+        for key, value in record['timings'].items():
+          stages[key].append(value)
+
+  elapsed = time.perf_counter() - start
+  return count, errors, elapsed, stages
+
+def printSummary(count, errors, elapsed, stages):
+  '''Prints the throughput and the percentiles of each stage of a batch run'''
+  print(f'{count} image(s) ({errors} error(s)) in {elapsed:.1f}s: {count / elapsed if elapsed > 0 else 0:.2f} images/s', file=sys.stderr)
+  for key, values in stages.items():
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    print(f'  {key}: p50 {p50:.1f}ms, p90 {p90:.1f}ms, p99 {p99:.1f}ms', file=sys.stderr)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Reads the song information of a directory of screenshots into JSON lines')
+  parser.add_argument('path', help='Directory or glob of the screenshots')
+  parser.add_argument('-o', '--output', help='JSON lines file to write to, defaults to stdout')
+  parser.add_argument('-w', '--workers', type=int, default=int(os.getenv('OCR_WORKERS', OCR_WORKERS)), help='Number of worker processes')
+  parser.add_argument('--mode', default='cropped', help='Asset mode of the templates')
+  args = parser.parse_args()
+
+  output = open(args.output, 'w') if args.output else sys.stdout
+  try:
+    printSummary(*runBatch(args.path, output, args.workers, args.mode))
+  finally:
+    if args.output:
+      output.close()
@@ -0,0 +1,221 @@
+# Benchmarks for the song information API
+import os
+os.environ["OPENCV_LOG_LEVEL"]="SILENT"
+
+import cv2
+import numpy as np
+
+import argparse
+import glob
+import json
+import sys
+import time
+from collections import defaultdict
+
+from api import ScoreAPI
+from ocr import CountingBackend, createBackend
+from functions import rescaleImage, strToSongInfo
+from matching import Frame
+from song_info import SongInfo
+
+# The stages of getSongInfo and the fields that each of them reads
+STAGES = {
+  'song': ['songName', 'difficulty'],
+  'rank': ['rank'],
+  'score': ['score', 'highScore'],
+  'maxCombo': ['maxCombo'],
+  'fastSlow': ['fast', 'slow'],
+  'notes': ['notes'],
+}
+
+def benchMatching(path, ocr=True, mode='cropped'):
+  '''Compares the located coordinates, SongInfo and timings of the pyramid and spectral matchers against the exhaustive matcher, which runs cv2.matchTemplate once per template
+  \nThe first image is matched before timing, so that the spectral matcher is timed with the spectra of the templates cached'''
+  exhaustive = ScoreAPI(mode, matcher='exhaustive')
+  apis = { 'exhaustive': exhaustive, 'pyramid': ScoreAPI(mode, matcher='pyramid'), 'spectral': ScoreAPI(mode, matcher='spectral') }
+  times = { name: 0.0 for name in apis }
+  locations, songInfos, files = 0, 0, glob.glob(path)
+
+  # Warm up the caches of every matcher with the templates of the exhaustive matcher, which are the ones compared
+  image = next((image for image in map(cv2.imread, files) if image is not None), None)
+  if image is not None:
+    for api in apis.values():
+      frame = Frame(rescaleImage(image))
+      for group, templates, window in exhaustive.templateGroups():
+        api.locate(frame, templates, window)
+
+  for file in files:
+    image = cv2.imread(file)
+    if image is None:
+      continue
+    rescaled = rescaleImage(image)
+    frames = { name: Frame(rescaled) for name in apis }
+
+    # Compare the location of every template group
+    for group, templates, window in exhaustive.templateGroups():
+      res = {}
+      for name, api in apis.items():
+        start = time.perf_counter()
+        res[name] = api.locate(frames[name], templates, window)
+        times[name] += time.perf_counter() - start
+      i1, s1, l1 = res['exhaustive']
+      for name, (i2, s2, l2) in res.items():
+        if i1 != i2 or l1 != l2:
+          locations += 1
+          print(f'{file} {group}: exhaustive {i1} at {l1} ({s1:.3f}), {name} {i2} at {l2} ({s2:.3f})')
+
+    # Compare the end to end result
+    if ocr:
+      expected, _ = exhaustive.getSongInfo(image)
+      for name, api in apis.items():
+        if api is exhaustive:
+          continue
+        actual, _ = api.getSongInfo(image)
+        if vars(expected) != vars(actual):
+          songInfos += 1
+          print(f'{file} SongInfo: exhaustive {expected}, {name} {actual}')
+
+  print(f'{len(files)} image(s), {locations} location mismatch(es), {songInfos} SongInfo mismatch(es)')
+  for name, total in times.items():
+    print(f'{name}: {total * 1000 / max(len(files), 1):.1f} ms of template matching per image')
+
+def loadCorpus(path):
+  '''Loads the labeled screenshots of a directory, where each image has a .gt.txt file in the format of songInfoToStr
+  \nThe SongInfo images written by writeData to testdata/songs can be used once their .gt.txt files are checked'''
+  corpus = []
+  for gt in sorted(glob.glob(f'{path}/*.gt.txt')):
+    stem = gt[:-len('.gt.txt')]
+    file = next((f'{stem}{ext}' for ext in ['.png', '.jpg', '.jpeg'] if os.path.exists(f'{stem}{ext}')), None)
+    with open(gt, 'r') as f:
+      label, error = strToSongInfo(f.read())
+    if file is None or label is None:
+      print(f'Skipping {gt}: {error if file else "no image"}', file=sys.stderr)
+      continue
+    corpus.append((file, label))
+  return corpus
+
+def fieldValues(songInfo):
+  '''Gets the values of the fields of a SongInfo that are compared against the ground truth'''
+  values = { field: getattr(songInfo, field) for fields in STAGES.values() for field in fields if field != 'notes' }
+  values.update({ f'notes.{type}': value for type, value in songInfo.notes.items() })
+  return values
+
+def runStages(api, counter, image):
+  '''Runs the stages of getSongInfo one at a time on an image
+  \nReturns the SongInfo and the milliseconds and Tesseract calls of each stage'''
+  stages = {}
+  def run(name, fn, *args):
+    counter.calls = 0
+    start = time.perf_counter()
+    value = fn(*args)
+    stages[name] = { 'ms': (time.perf_counter() - start) * 1000, 'calls': counter.calls }
+    return value
+
+  frame = run('rescale', lambda: Frame(rescaleImage(image), image.shape[:2]))
+  song, difficulty = run('song', api.getSong, frame)
+  rank = run('rank', api.getRank, frame)
+  score, highScore = run('score', api.getScore, frame)
+  maxCombo, fastSlow = run('maxCombo', api.getMaxCombo, frame)
+  fast, slow = run('fastSlow', api.getFastSlow, frame) if fastSlow else (-1, -1)
+  notes = run('notes', api.getNotes, frame)
+  return SongInfo(song, difficulty, rank, score, highScore, maxCombo, notes, fast, slow), stages
+
+def benchStages(path):
+  '''Runs a labeled corpus through ScoreAPI stage by stage
+  \nReturns the latency percentiles and mean Tesseract calls of each stage, and the accuracy of each field'''
+  counter = CountingBackend(createBackend())
+  api = ScoreAPI(ocr=counter)
+  times, calls = defaultdict(list), defaultdict(list)
+  correct, total = defaultdict(int), defaultdict(int)
+
+  corpus = loadCorpus(path)
+  try:
+    for file, label in corpus:
+      image = cv2.imread(file)
+      if image is None:
+        print(f'Skipping {file}: unable to decode image', file=sys.stderr)
+        continue
+      songInfo, stages = runStages(api, counter, image)
+      for name, res in stages.items():
+        times[name].append(res['ms'])
+        calls[name].append(res['calls'])
+
+      expected, actual = fieldValues(label), fieldValues(songInfo)
+      for field, value in expected.items():
+        total[field] += 1
+        if actual.get(field) == value:
+          correct[field] += 1
+        else:
+          print(f'{file} {field}: expected {value!r}, got {actual.get(field)!r}', file=sys.stderr)
+  finally:
+    counter.close()
+
+  return {
+    'images': len(times['rescale']),
+    'stages': { name: {
+      'p50': float(np.percentile(values, 50)),
+      'p90': float(np.percentile(values, 90)),
+      'calls': float(np.mean(calls[name])),
+    } for name, values in times.items() },
+    'accuracy': { field: correct[field] / total[field] for field in total },
+  }
+
+def compareBaseline(results, baseline, latencyTolerance, latencySlack, accuracyTolerance):
+  '''Compares benchmark results against a baseline
+  \nA stage regresses if its median latency grows by more than the relative tolerance and the absolute slack in ms, or if it makes more Tesseract calls.
+  A field regresses if its accuracy drops by more than the accuracy tolerance
+  \nReturns the list of regressions'''
+  regressions = []
+  for name, base in baseline['stages'].items():
+    if name not in results['stages']:
+      continue
+    res = results['stages'][name]
+    if res['p50'] > base['p50'] * (1 + latencyTolerance) and res['p50'] - base['p50'] > latencySlack:
+      regressions.append(f'{name}: p50 {base["p50"]:.1f}ms -> {res["p50"]:.1f}ms')
+    if res['calls'] > base['calls']:
+      regressions.append(f'{name}: Tesseract calls {base["calls"]:.2f} -> {res["calls"]:.2f}')
+  for field, base in baseline['accuracy'].items():
+    if field in results['accuracy'] and results['accuracy'][field] < base - accuracyTolerance:
+      regressions.append(f'{field}: accuracy {base:.1%} -> {results["accuracy"][field]:.1%}')
+  return regressions
+
+def printStages(results):
+  '''Prints the latency, Tesseract calls and accuracy of a stage benchmark'''
+  print(f'{results["images"]} image(s)')
+  for name, res in results['stages'].items():
+    print(f'  {name}: p50 {res["p50"]:.1f}ms, p90 {res["p90"]:.1f}ms, {res["calls"]:.2f} Tesseract call(s)')
+  for field, accuracy in results['accuracy'].items():
+    print(f'  {field}: {accuracy:.1%} accurate')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmarks for the song information API')
+  parser.add_argument('benchmark', choices=['matching', 'stages'])
+  parser.add_argument('path', help='Glob of the screenshots to benchmark on, or the directory of the labeled screenshots for stages')
+  parser.add_argument('--no-ocr', action='store_true', help='Only compare the template matching')
+  parser.add_argument('--mode', default='cropped', help='Asset mode of the templates to compare the matchers on')
+  parser.add_argument('--baseline', default='bench_baseline.json', help='Baseline file of the stage benchmark')
+  parser.add_argument('--save', action='store_true', help='Save the results of the stage benchmark as the baseline')
+  parser.add_argument('--latency-tolerance', type=float, default=0.2, help='Allowed relative growth of the median latency of a stage')
+  parser.add_argument('--latency-slack', type=float, default=2.0, help='Allowed absolute growth of the median latency of a stage in ms')
+  parser.add_argument('--accuracy-tolerance', type=float, default=0.0, help='Allowed drop of the accuracy of a field')
+  args = parser.parse_args()
+
+  if args.benchmark == 'matching':
+    benchMatching(args.path, not args.no_ocr, args.mode)
+  elif args.benchmark == 'stages':
+    results = benchStages(args.path)
+    printStages(results)
+    if args.save:
+      with open(args.baseline, 'w') as f:
+        json.dump(results, f, indent=2)
+      print(f'Saved the baseline to {args.baseline}')
+    elif os.path.exists(args.baseline):
+      with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+      regressions = compareBaseline(results, baseline, args.latency_tolerance, args.latency_slack, args.accuracy_tolerance)
+      for regression in regressions:
+        print(f'Regression: {regression}')
+      if regressions:
+        sys.exit(1)
+    else:
+      print(f'No baseline at {args.baseline}, run with --save to create one')
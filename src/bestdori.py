@@ -16,15 +16,15 @@ def headers(path: str):
 def getSongs():
   return getJson(SONGS_URL + SONGS_ALL, (SONGS_URL + SONGS_ALL).split('.com/')[1])
 
-def getSong(songId: str):
-  return getJson(f'{SONGS_URL}{songId}.json', f'{SONGS_URL}{songId}.json'.split('.com/')[1])
+def getSong(songId: str, timeout=None):
+  return getJson(f'{SONGS_URL}{songId}.json', f'{SONGS_URL}{songId}.json'.split('.com/')[1], timeout)
     
 def getBands():
   return getJson(BANDS_URL, BANDS_URL.split('.com/')[1])
 
-def getJson(url: str, path: str):
+def getJson(url: str, path: str, timeout=None):
   request = urllib.request.Request(url, headers=headers(path))
-  with urllib.request.urlopen(request) as response:
+  with urllib.request.urlopen(request, timeout=timeout) as response:
     data = json.loads(response.read())
     return data
 
@@ -11,12 +11,15 @@ import os
 import datetime
 import logging
 
-from api import ScoreAPI
+from ocr_pool import OCRPool
+from result_cache import ResultCache
+from title_index import TitleIndex
 from db import Database
 import bot_commands
 import bot_commands_admin
 from bot_util_functions import msgLog
 from bot_help import *
+from consts import OCR_WORKERS, OCR_TIERED, OCR_PARALLEL
 
 import sys
 
@@ -39,7 +42,7 @@ intents.message_content = True
 bot = commands.Bot(command_prefix='$', intents=intents, help_command=None)
 
 # Create API
-scoreAPI: ScoreAPI = None
+ocrPool: OCRPool = None
 db: Database = None
 
 async def dbCommand(ctx: commands.Context, cmd: any):
@@ -54,7 +57,7 @@ async def dbCommand(ctx: commands.Context, cmd: any):
 @bot.command(aliases=commandAliases['newScores'])
 async def newScores(ctx: commands.Context, defaultTag: str = "", compare: bool = True):
   msgLog(ctx)
-  await dbCommand(ctx, bot_commands.newScores(scoreAPI, bot, db, ctx, compare, defaultTag))
+  await dbCommand(ctx, bot_commands.newScores(ocrPool, bot, db, ctx, compare, defaultTag))
 
 # Gets the user's scores from the database given a query
 @bot.command(aliases=commandAliases['getScores'])
@@ -157,15 +160,26 @@ async def ping(ctx: commands.Context):
   dbStatus = await db.ping_server()
   await ctx.send(f"Database: {'Connected' if dbStatus else 'Disconnected'}")
 
+@bot.command()
+@has_permissions(administrator=True)
+async def metrics(ctx: commands.Context):
+  msgLog(ctx)
+  await bot_commands_admin.metricsSummary(ctx)
+
 async def main():
   logging.info("Starting bot")
-  global scoreAPI
-  scoreAPI = ScoreAPI(draw=True)
+  global ocrPool
+  # The results of re-posted screenshots are cached, and kept across restarts if RESULT_CACHE is a path
+  cache = ResultCache(path=os.getenv('RESULT_CACHE'))
+  ocrPool = OCRPool(int(os.getenv('OCR_WORKERS', OCR_WORKERS)), draw=True, cache=cache, tiered=OCR_TIERED, parallel=OCR_PARALLEL, titles=TitleIndex())
   global db
   db = Database()
   # For some reason the bot logs twice after loading extensions
   await bot.load_extension("cogs.daily_reset")
-  await bot.start(TOKEN)
+  try:
+    await bot.start(TOKEN)
+  finally:
+    ocrPool.shutdown(wait=False)
 
 if __name__ == '__main__':
   asyncio.run(main())
\ No newline at end of file
@@ -10,11 +10,11 @@ from dotenv import load_dotenv
 import os
 
 import cv2
-import numpy as np
 
-from api import ScoreAPI
+from ocr_pool import OCRPool
+from metrics import metrics
 from chart import songCountGraph
-from functions import getDifficulty, hasDifficulty, hasTag, songInfoToStr, getAboutTP, validateSong
+from functions import getDifficulty, hasDifficulty, hasTag, songInfoToStr, getAboutTP, validateSong, decodeImage
 from bot_util_functions import confirmSongInfo, getBandEmoji, idFromBandEmoji, promptTag, compareSongWithBest, printSongCompare
 from song_info import SongInfo
 from db import Database
@@ -22,7 +22,7 @@ from consts import tags, bestDict, TIMEOUT
 from bot_help import getCommandHelp
 
 async def newScores(
-  scoreAPI: ScoreAPI, 
+  ocrPool: OCRPool, 
   bot: commands.Bot, 
   db: Database, 
   ctx: commands.Context, 
@@ -45,12 +45,19 @@ async def newScores(
     # Get the file
     fp = BytesIO()
     await file.save(fp)
-    # Get a file that the API can use
-    image_np = np.frombuffer(fp.read(), np.uint8)
-    img = cv2.imdecode(image_np, cv2.IMREAD_COLOR)
+    # Get a file that the API can use, decoded straight to the size the API reads it at
+    try:
+      with metrics.timer('decode'):
+        img, resolution = decodeImage(fp.read())
+    except ValueError as e:
+      logging.warning(f'newScores: Unable to decode {file.filename}: {e}')
+      await ctx.send(f'Skipping song {x+1}/{len(files)}: {e}')
+      continue
 
     # Get the song info
-    output, res = scoreAPI.getSongInfo(img)
+    output, res = await ocrPool.getSongInfo(img, resolution)
+    # Keep the SongInfo that was read, to teach the title index the song once the user confirms it
+    read = output
     tag = defaultTag if defaultTag in tags else tags[0]
     key, song, info = db.bestdori.getSong(output.songName)
     songValid, validationErrors = validateSong(output, info)
@@ -123,6 +130,12 @@ async def newScores(
         pass
 
     if not output is None:
+      # Teach the title index the song the user confirmed, which is the one that was read only if they saved it as is
+      titleKey, titleSong = key, song
+      if str(reaction.emoji) not in ['✅', '☑️']:
+        titleKey, titleSong, _ = db.bestdori.getSong(output.songName, songInfo=False)
+      if titleKey:
+        ocrPool.confirmTitle(read, titleKey, db.bestdori.getSongName(titleSong))
       output.songName = db.bestdori.getSongName(song)
       if compare:
         compareRes = await compareSongWithBest(ctx, db, output, tag)
@@ -2,6 +2,8 @@
 from discord.ext import commands
 import sys
 
+from metrics import metrics, summarize
+
 async def version(ctx: commands.Context, version: str, ping: bool):
   with open(f'{sys.path[0]} + /../versions/{version}.txt', 'r') as file:
     data = file.read()
@@ -16,4 +18,17 @@ async def announcements(ctx: commands.Context, ping: bool):
   if ping:
     await ctx.send(f'@here Announcements:\n{data}')
   else:
-    await ctx.send(f'Announcements:\n{data}')
\ No newline at end of file
+    await ctx.send(f'Announcements:\n{data}')
+
+async def metricsSummary(ctx: commands.Context):
+  '''Sends the summary of the OCR metrics since the last reset, then resets them'''
+  # Drain the metrics in one step, so that nothing recorded while the summary is made is lost
+  summary = summarize(metrics.drain())
+  # Split the summary into messages that fit in the message limit
+  msgText = ''
+  for line in summary.splitlines():
+    if len(msgText) + len(line) > 1990:
+      await ctx.send(f'```{msgText}```')
+      msgText = ''
+    msgText += line + '\n'
+  await ctx.send(f'```{msgText}```')
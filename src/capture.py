@@ -0,0 +1,134 @@
+# Background writer of the debug captures, so that writing to testdata stays off of the OCR hot path
+import cv2
+
+import atexit
+import datetime
+import glob
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+from metrics import metrics
+from consts import CAPTURE_QUEUE_SIZE, CAPTURE_SAMPLE_RATE, CAPTURE_MAX_BYTES
+
+CAPTURE_DIR = f'{sys.path[0]} + /../testdata'
+# The directories of testdata that the captures are written to
+CAPTURE_PATHS = ['data', 'songs']
+
+def captureStem(file):
+  '''Gets the path of a capture file without its extension, which is shared by the image and its .gt.txt file'''
+  return file[:-len('.gt.txt')] if file.endswith('.gt.txt') else os.path.splitext(file)[0]
+
+class CaptureWriter:
+  '''Writes the images and OCR results of writeData to testdata on a background thread
+  \nOnly a sample of the captures is kept, and captures are dropped instead of waited on when the queue is full.
+  Once the captures take up more than the size cap, the oldest ones are deleted'''
+  def __init__(self, root=CAPTURE_DIR, queueSize=CAPTURE_QUEUE_SIZE, sampleRate=CAPTURE_SAMPLE_RATE, maxBytes=CAPTURE_MAX_BYTES):
+    self.root = root
+    self.sampleRate = sampleRate
+    self.maxBytes = maxBytes
+    self.queue = queue.Queue(queueSize)
+    # Bytes written since the captures were last counted
+    self.written = 0
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def submit(self, img, prefix, res='', path='data', ext='tif'):
+    '''Queues a capture to be written, returning whether it was queued'''
+    if random.random() >= self.sampleRate:
+      metrics.count('capture sampled out')
+      return False
+    name = f"{prefix}-{str(datetime.datetime.now()).split('.')[0].replace(':', '-')}"
+    try:
+      # Copy the image since annotations may still be drawn on it
+      self.queue.put_nowait((img.copy(), str(res), path, name, ext))
+    except queue.Full:
+      metrics.count('capture dropped')
+      return False
+    return True
+
+  def run(self):
+    self.prune()
+    while True:
+      item = self.queue.get()
+      try:
+        if item is None:
+          return
+        self.write(*item)
+      except Exception as e:
+        metrics.count('capture failed')
+        logging.warning(f'Capture: Unable to write capture: {e}')
+      finally:
+        self.queue.task_done()
+
+  def write(self, img, res, path, name, ext):
+    '''Writes a capture image and its .gt.txt file'''
+    start = time.perf_counter()
+    stem = f'{self.root}/{path}/{name}'
+    if not cv2.imwrite(f'{stem}.{ext}', img):
+      raise OSError(f'Unable to write {stem}.{ext}')
+    with open(f'{stem}.gt.txt', 'w') as f:
+      f.write(res)
+    metrics.record('capture write', time.perf_counter() - start)
+    metrics.count('capture written')
+
+    self.written += os.path.getsize(f'{stem}.{ext}') + os.path.getsize(f'{stem}.gt.txt')
+    # Count the captures again every so often, since other processes write to testdata too
+    if self.written > self.maxBytes / 20:
+      self.prune()
+
+  def prune(self):
+    '''Deletes the oldest captures until the captures are back under 90% of the size cap'''
+    self.written = 0
+    captures = {}
+    for path in CAPTURE_PATHS:
+      for file in glob.glob(f'{self.root}/{path}/*'):
+        try:
+          stat = os.stat(file)
+        except OSError:
+          continue
+        mtime, size, files = captures.get(captureStem(file), (0, 0, []))
+        captures[captureStem(file)] = (max(mtime, stat.st_mtime), size + stat.st_size, files + [file])
+
+    total = sum(size for _, size, _ in captures.values())
+    if total <= self.maxBytes:
+      return
+    for _, size, files in sorted(captures.values()):
+      if total <= self.maxBytes * 0.9:
+        break
+      for file in files:
+        try:
+          os.remove(file)
+        except OSError:
+          pass
+      total -= size
+      metrics.count('capture evicted')
+
+  def flush(self):
+    '''Waits for the queued captures to be written'''
+    self.queue.join()
+
+  def close(self, timeout=5):
+    '''Writes the queued captures and stops the writer thread'''
+    try:
+      self.queue.put(None, timeout=timeout)
+    except queue.Full:
+      return
+    self.thread.join(timeout)
+
+# The capture writer of the current process, started on first use
+writer: CaptureWriter = None
+writerLock = threading.Lock()
+
+def captureWriter():
+  '''Gets the capture writer of the current process, starting it if needed'''
+  global writer
+  with writerLock:
+    if writer is None:
+      writer = CaptureWriter()
+      atexit.register(writer.close)
+    return writer
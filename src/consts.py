@@ -1,5 +1,77 @@
 TIMEOUT = 180.0
+# Number of worker processes used for OCR, can be overridden with the OCR_WORKERS environment variable
+OCR_WORKERS = 2
+# Largest screenshot in pixels that is decoded, can be overridden with the IMAGE_MAX_PIXELS environment variable
+IMAGE_MAX_PIXELS = 50_000_000
+# Height of the blank bands between the ROIs of a batched OCR page
+BATCH_GAP = 20
+# OCR backend, either 'workers' (long-lived Tesseract processes, needs tesserocr, which is not in the requirements) or 'pytesseract'
+OCR_BACKEND = 'pytesseract'
+# Seconds to wait for a recognizer worker before falling back to pytesseract
+OCR_WORKER_TIMEOUT = 10.0
+# Size (width, height) that the digit glyphs are normalized to before being compared
+DIGIT_SIZE = (16, 16)
+# Minimum area in pixels of a connected component for it to be a digit glyph
+DIGIT_MIN_AREA = 4
+# Minimum glyph correlation for a number read by the digit recognizer to be used instead of Tesseract
+DIGIT_CONFIDENCE = 0.8
+# Whether the numbers are read with the digit recognizer before Tesseract, which needs the templates made with buildDigitTemplates in assets/digits
+DIGIT_RECOGNIZER = False
+# Seconds to wait for the Bestdori data of a song when checking the results of the tiered pipeline
+BESTDORI_TIMEOUT = 2.0
+# Whether the bot reads the fields with the cheap recognizers first, only using Tesseract for the fields that fail the checks
+# Off by default, since without the digit templates every number is read with Tesseract anyway
+OCR_TIERED = False
+# The (block size, C) of the adaptive threshold of the binary frame that most ROIs are cut from
+BINARY_THRESHOLD = (9, 2)
+# The (block size, C) of the adaptive thresholds that escalated fields are read with, after their usual threshold
+# A variant equal to the threshold the ROI was already read with is skipped
+THRESHOLD_VARIANTS = [(9, 2), (15, 4), (25, 8)]
+# Whether the bot runs the independent stages of a screenshot concurrently when OCR_TIERED is off, and on how many threads
+OCR_PARALLEL = False
+STAGE_THREADS = 4
 ENABLE_LOGGING = True
+# Number of captures that can wait to be written before new ones are dropped
+CAPTURE_QUEUE_SIZE = 64
+# Fraction of the captures that are written to testdata
+CAPTURE_SAMPLE_RATE = 1.0
+# Bytes that the captures in testdata can take up before the oldest ones are deleted
+CAPTURE_MAX_BYTES = 512 * 1024 * 1024
+# Number of screenshots whose results are cached for when they are posted again
+RESULT_CACHE_SIZE = 64
+# Maximum number of differing bits between the hashes of two screenshots for them to be compared
+RESULT_HASH_DISTANCE = 6
+# Size (width, height) of the thumbnails that cached screenshots are compared with
+RESULT_THUMB_SIZE = (480, 270)
+# Maximum local mean difference between the thumbnails of the same screenshot
+RESULT_DIFF_THRESHOLD = 24
+# Number of frames per second of a video that are checked for result screens
+VIDEO_SAMPLE_RATE = 2.0
+# Port of the OCR service, can be overridden with the PORT environment variable
+SERVER_PORT = 8080
+# Maximum number of images sent to a worker at once, and seconds to wait for more images to fill a batch
+SERVER_BATCH_SIZE = 4
+SERVER_BATCH_WAIT = 0.01
+# Number of images that can wait in the queue before uploads are rejected
+SERVER_QUEUE_SIZE = 64
+# Maximum size in bytes of an upload
+SERVER_MAX_UPLOAD = 32 * 1024 * 1024
+# Size (width, height) in bits of the fingerprints of the song title crops
+TITLE_FINGERPRINT_SIZE = (128, 16)
+# Maximum fraction of differing bits between the fingerprints of the same title
+TITLE_MAX_DISTANCE = 0.06
+# Maximum relative difference between the widths of the same title
+TITLE_WIDTH_TOLERANCE = 0.05
+# Minimum share of the colored pixels of the difficulty badge that must be closest to the same difficulty color
+DIFFICULTY_CONFIDENCE = 0.8
+# Minimum saturation and value of the colored pixels of the difficulty badge, leaving out its white text
+BADGE_MIN_SATURATION = 80
+BADGE_MIN_VALUE = 80
+# Minimum match score of the rank badge on the black and white frame, the average of the binarized rank templates, which matches each rank loosely
+# The ranks score 0.27 to 0.49 on light to dark backgrounds, while the other parts of the result screen score below 0.17
+RANK_BADGE_THRESHOLD = 0.22
+# Size that the binarized rank glyphs are downsampled to before they are compared
+RANK_GLYPH_SIZE = (24, 24)
 ranks = ['SS', 'S', 'A', 'B', 'C', 'D']
 types = ['Perfect', 'Great', 'Good', 'Bad', 'Miss']
 
@@ -66,6 +138,29 @@ noteTypes = {
   },
 }
 maxComboDim = [((5, 10), (-5, 65)), ((0, 5), (0, 47))]
+# Regions of the rescaled result screen that each group of templates is searched in,
+# as (left, top, right, bottom) fractions of the image. The whole image is searched if the best match is below MATCH_THRESHOLD
+searchWindows = {
+  'difficulties': (0, 0, 0.6, 0.35),
+  'ranks': (0, 0.1, 0.6, 0.8),
+  'scoreIcon': (0, 0.2, 0.7, 0.9),
+  'maxCombo': (0.3, 0.3, 1, 1),
+  'fastSlow': (0.3, 0.3, 1, 1),
+  'noteTypes': (0.3, 0.2, 1, 1),
+}
+MATCH_THRESHOLD = 0.7
+# Scale of the coarse level of the pyramid template matcher, and the smallest downscaled template size it is used for
+PYRAMID_SCALE = 0.25
+PYRAMID_MIN_SIZE = 6
+# Number of screenshot resolutions to remember the template locations of, and how far in pixels a cached location is checked around
+LAYOUT_CACHE_SIZE = 32
+LAYOUT_RADIUS = 4
+# Multiple that the sizes of the templates are padded to for the spectral matcher, so that templates of similar sizes share the spectrum of the frame
+SPECTRUM_PAD = 64
+# Bytes of template spectra that the spectral matcher keeps between screenshots, enough for every template at one screenshot size
+SPECTRUM_CACHE_BYTES = 256 * 1024 * 1024
+# How far in pixels each note type label is checked around where the spacing of the rows puts it
+NOTE_ROW_RADIUS = 6
 difficulties = ['Easy', 'Normal', 'Hard', 'Expert', 'Special']
 tags = ['live', 'multilive', 'event']
 tagIcons = ['🎵', '🎤', '🎉']
@@ -0,0 +1,145 @@
+# Template based recognizer for the digits of the game font
+import numpy as np
+import cv2
+
+import glob
+import os
+import sys
+from collections import defaultdict
+
+from functions import ASSETS_DIR, thresholdAdaptive, thresholdFixed
+from consts import DIGIT_SIZE, DIGIT_MIN_AREA
+
+def foreground(roi):
+  '''Gets the glyph pixels of a black and white ROI as a 0/1 image, assuming the background touches the border'''
+  border = np.concatenate((roi[0], roi[-1], roi[:, 0], roi[:, -1]))
+  # If the background is white, the glyphs are the dark pixels
+  return (roi < 128 if np.median(border) >= 128 else roi >= 128).astype(np.uint8)
+
+def glyphImage(fg, box):
+  '''Centers a glyph in a square box of its height and resizes it to the digit template size'''
+  x, y, w, h = box
+  size = max(w, h)
+  square = np.zeros((size, size), np.float32)
+  square[(size-h)//2:(size-h)//2+h, (size-w)//2:(size-w)//2+w] = fg[y:y+h, x:x+w]
+  return cv2.resize(square, DIGIT_SIZE, interpolation=cv2.INTER_AREA)
+
+def descriptor(glyph):
+  '''Gets the zero mean, unit norm vector of a glyph image so that dot products are correlations'''
+  v = glyph.flatten().astype(np.float32)
+  v -= v.mean()
+  norm = np.linalg.norm(v)
+  return v / norm if norm > 0 else v
+
+def segmentLines(fg):
+  '''Segments the glyphs of a 0/1 image with connected components
+  \nReturns the lines of glyph boxes (x, y, w, h) from top to bottom, each sorted from left to right'''
+  n, _, stats, _ = cv2.connectedComponentsWithStats(fg, connectivity=8)
+  boxes = [tuple(int(v) for v in stats[i, :4]) for i in range(1, n) if stats[i, cv2.CC_STAT_AREA] >= DIGIT_MIN_AREA]
+
+  # Group the boxes into lines of vertically overlapping boxes
+  lines = []
+  for box in sorted(boxes, key=lambda b: b[1] + b[3] / 2):
+    center = box[1] + box[3] / 2
+    line = next((l for l in lines if l['top'] <= center <= l['bottom']), None)
+    if line is None:
+      lines.append({ 'top': box[1], 'bottom': box[1] + box[3], 'boxes': [box] })
+    else:
+      line['top'], line['bottom'] = min(line['top'], box[1]), max(line['bottom'], box[1] + box[3])
+      line['boxes'].append(box)
+
+  res = []
+  for line in lines:
+    # Drop the specks that are much shorter than the glyphs of the line
+    tallest = max(b[3] for b in line['boxes'])
+    glyphs = sorted((b for b in line['boxes'] if b[3] >= tallest / 2), key=lambda b: b[0])
+
+    # Merge the pieces of glyphs that were broken up by the threshold
+    merged = []
+    for box in glyphs:
+      if merged and box[0] < merged[-1][0] + merged[-1][2] - min(box[2], merged[-1][2]) / 2:
+        x, y, w, h = merged[-1]
+        x2, y2 = max(x + w, box[0] + box[2]), max(y + h, box[1] + box[3])
+        x, y = min(x, box[0]), min(y, box[1])
+        merged[-1] = (x, y, x2 - x, y2 - y)
+      else:
+        merged.append(box)
+    res.append(merged)
+  return res
+
+def lastWord(boxes):
+  '''Gets the glyph boxes of the last word of a line, splitting words on gaps wider than a third of the glyph height'''
+  height = np.median([b[3] for b in boxes])
+  start = 0
+  for x in range(1, len(boxes)):
+    if boxes[x][0] - (boxes[x-1][0] + boxes[x-1][2]) > height / 3:
+      start = x
+  return boxes[start:]
+
+class DigitRecognizer:
+  '''Recognizes numbers in the game font by correlating each glyph against the digit templates
+  \nThe templates are read from assets/digits and can be built from the testdata with buildDigitTemplates. Without a path, the recognizer is disabled'''
+  def __init__(self, path=f'{ASSETS_DIR}/digits'):
+    templates = [cv2.imread(f'{path}/{digit}.png', cv2.IMREAD_GRAYSCALE) for digit in range(10)] if path is not None else [None]
+    # Without a template for every digit, the recognizer is never confident
+    self.enabled = all(template is not None for template in templates)
+    if self.enabled:
+      self.matrix = np.stack([descriptor(cv2.resize(t.astype(np.float32) / 255, DIGIT_SIZE, interpolation=cv2.INTER_AREA)) for t in templates])
+
+  def classify(self, fg, boxes):
+    '''Classifies the glyph boxes of a number, returning the number and the confidence of the least confident glyph'''
+    if not boxes:
+      return None, 0.0
+    glyphs = np.stack([descriptor(glyphImage(fg, box)) for box in boxes])
+    scores = glyphs @ self.matrix.T
+    digits = scores.argmax(axis=1)
+    value = int(''.join(str(d) for d in digits))
+    return value, float(scores.max(axis=1).min())
+
+  def recognize(self, roi):
+    '''Recognizes the number in a single line black and white ROI
+    \nReturns the number and a confidence between -1 and 1, or (None, 0) if there is no number'''
+    if not self.enabled or roi.size == 0:
+      return None, 0.0
+    fg = foreground(roi)
+    lines = segmentLines(fg)
+    # A number ROI only has a single line of glyphs
+    if len(lines) != 1:
+      return None, 0.0
+    return self.classify(fg, lines[0])
+
+  def recognizeLines(self, roi):
+    '''Recognizes the number at the end of every line of a black and white ROI
+    \nReturns a list of (number, confidence) from top to bottom'''
+    if not self.enabled or roi.size == 0:
+      return []
+    fg = foreground(roi)
+    return [self.classify(fg, lastWord(line)) for line in segmentLines(fg)]
+
+def buildDigitTemplates(path=f'{sys.path[0]} + /../testdata/data', out=f'{ASSETS_DIR}/digits'):
+  '''Builds the digit templates by averaging the glyphs of the numeric crops written by writeData'''
+  thresholds = { 'Note': thresholdAdaptive, 'FastSlow': thresholdAdaptive, 'MaxCombo': thresholdFixed }
+  glyphs = defaultdict(list)
+  for gt in glob.glob(f'{path}/*.gt.txt'):
+    prefix = os.path.basename(gt).split('-')[0]
+    with open(gt, 'r') as f:
+      label = f.read().strip()
+    crop = cv2.imread(gt.replace('.gt.txt', '.tif'), cv2.IMREAD_GRAYSCALE)
+    if prefix not in thresholds or not label.isdecimal() or crop is None:
+      continue
+
+    # Only use the crops where every digit of the label has its own glyph
+    fg = foreground(thresholds[prefix](crop))
+    lines = segmentLines(fg)
+    if len(lines) != 1 or len(lines[0]) != len(label):
+      continue
+    for digit, box in zip(label, lines[0]):
+      glyphs[digit].append(glyphImage(fg, box))
+
+  os.makedirs(out, exist_ok=True)
+  for digit, images in glyphs.items():
+    cv2.imwrite(f'{out}/{digit}.png', (np.mean(images, axis=0) * 255).astype(np.uint8))
+  return { digit: len(images) for digit, images in glyphs.items() }
+
+if __name__ == '__main__':
+  print(buildDigitTemplates(*sys.argv[1:]))
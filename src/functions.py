@@ -1,14 +1,17 @@
 
 import numpy as np
 import cv2
-from shapely.geometry import LineString
+from PIL import Image
 
+import os
 import sys
+from io import BytesIO
 
 from consts import *
 from song_info import SongInfo
 
 from collections import defaultdict
+from functools import lru_cache
 
 ASSETS_DIR = f'{sys.path[0]} + /../assets'
 
@@ -36,13 +39,20 @@ def hasTag(t: str):
   except:
     return False
 
+def readTemplate(path):
+  '''Reads a template as a contiguous grayscale image, or None if it does not exist'''
+  template = cv2.imread(path)
+  if template is None:
+    return None
+  return np.ascontiguousarray(cv2.cvtColor(template, cv2.COLOR_BGR2GRAY))
+
 def fetchRanks(path):
   '''Fetches the templates of the different ranks'''
   # List of ranks
   imgs = []
   for rank in ranks:
     ext = "png" if path == 'direct' else "jpg"
-    template = cv2.imread(f'{ASSETS_DIR}/{path}/rank/{rank}.{ext}')
+    template = readTemplate(f'{ASSETS_DIR}/{path}/rank/{rank}.{ext}')
     # If the template exists, add it to the list
     if not template is None:
       imgs.append(( template, rank ))
@@ -54,7 +64,7 @@ def fetchNoteTypes(path):
   # List of note types and variables for OCR matching
   imgs = defaultdict(list)
   for key, value in noteTypes.items():
-    template = cv2.imread(f'{ASSETS_DIR}/{path}/score/{key}.{value["ext"]}')
+    template = readTemplate(f'{ASSETS_DIR}/{path}/score/{key}.{value["ext"]}')
     if not template is None:
       # If the template exists, add it to the list
       imgs[value['type']].append(( template, value ))
@@ -66,7 +76,7 @@ def fetchDifficulties(path):
   imgs = []
   for difficulty in difficulties:
     ext = "png" if path == 'direct' else "jpg"
-    template = cv2.imread(f'{ASSETS_DIR}/{path}/difficulty/{difficulty}.{ext}')
+    template = readTemplate(f'{ASSETS_DIR}/{path}/difficulty/{difficulty}.{ext}')
     if not template is None:
       # If the template exists, add it to the list
       imgs.append(( template, difficulty ))
@@ -75,17 +85,27 @@ def fetchDifficulties(path):
 def fetchScoreIcon(path):
   '''Fetches the score icon'''
   ext = "png" if path == 'direct' else "jpg"
-  return cv2.imread(f'{ASSETS_DIR}/{path}/ScoreIcon.{ext}')
+  return readTemplate(f'{ASSETS_DIR}/{path}/ScoreIcon.{ext}')
 
 def fetchMaxCombo(path):
   '''Fetches the max combo template'''
   ext = "png" if path == 'direct' else "jpg"
-  return cv2.imread(f'{ASSETS_DIR}/{path}/Max combo.{ext}'), cv2.imread(f'{ASSETS_DIR}/{path}/Max combo small.{ext}')
+  return readTemplate(f'{ASSETS_DIR}/{path}/Max combo.{ext}'), readTemplate(f'{ASSETS_DIR}/{path}/Max combo small.{ext}')
 
 def fetchFastSlow(path):
   '''Fetches the fast and slow templates'''
   ext = "png" if path == 'direct' else "jpg"
-  return cv2.imread(f'{ASSETS_DIR}/{path}/fast.{ext}'), cv2.imread(f'{ASSETS_DIR}/{path}/slow.{ext}')
+  return readTemplate(f'{ASSETS_DIR}/{path}/fast.{ext}'), readTemplate(f'{ASSETS_DIR}/{path}/slow.{ext}')
+
+def thresholdAdaptive(image_gray, blockSize=9, C=2):
+  '''Makes a grayscale image black and white for OCR using an adaptive threshold'''
+  return cv2.adaptiveThreshold(image_gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,\
+        cv2.THRESH_BINARY, blockSize, C)
+
+def thresholdFixed(image_gray, threshold=150):
+  '''Makes a grayscale image black and white for OCR using a fixed threshold'''
+  (_, blackAndWhiteImage) = cv2.threshold(image_gray, threshold, 255, cv2.THRESH_BINARY)
+  return blackAndWhiteImage
 
 def songInfoToStr(song: SongInfo):
   '''Converts a SongInfo object to a formatted string'''
@@ -151,7 +171,14 @@ def strToSongInfo(song: str):
   except:
     return None, 'Invalid input.'
 
+# The curve that the rescaled width is taken from, sampled at every pixel like the line it is intersected with
+CURVE_X = np.arange(450, 3000, 1)
+CURVE_Y = 248.515 * np.log(0.413359 * CURVE_X - 179.201) - 581.131
+
+@lru_cache(maxsize=256)
 def calculateImgDimensions(width, height):
+  '''Calculates the dimensions to rescale an image to from the second intersection of the sampled curve and the line of its aspect ratio
+  \nRaises ValueError if the aspect ratio is too wide for the line to cross the curve twice'''
   if width / height < 16 / 9:
     w = width
     h = int(w * 9 / 16)
@@ -159,17 +186,17 @@ def calculateImgDimensions(width, height):
     w = width
     h = height
 
-  x = np.arange(450, 3000, 1)
-  y = 248.515 * np.log(0.413359 * x - 179.201) - 581.131
-  y2 = h/w * x
-
-  line1 = LineString(np.column_stack((x, y)))
-  line2 = LineString(np.column_stack((x, y2)))
-  intersection = line1.intersection(line2)
+  # Both lines are piecewise linear over the same samples, so their difference crosses zero linearly between samples
+  d = CURVE_Y - h/w * CURVE_X
+  crossings = np.flatnonzero(np.sign(d[:-1]) * np.sign(d[1:]) < 0)
+  touches = np.flatnonzero(d == 0)
+  points = sorted([CURVE_X[i] + d[i] / (d[i] - d[i+1]) for i in crossings] + [CURVE_X[i] for i in touches])
 
   # get the second intersection point
-  p = list(intersection.geoms)[1]
-  return (int(p.x), int(p.x * (height / width)))
+  if len(points) < 2:
+    raise ValueError(f'Unsupported aspect ratio ({width}x{height})')
+  x = points[1]
+  return (int(x), int(x * (height / width)))
 
 def rescaleImage(img):
   w = int(img.shape[1])
@@ -177,6 +204,36 @@ def rescaleImage(img):
   dim = calculateImgDimensions(w, h)
   return cv2.resize(img, dim, interpolation=cv2.INTER_AREA)
 
+# The reduced decodes of OpenCV from the largest reduction down
+REDUCED_DECODES = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+def decodeImage(data, maxPixels=int(os.getenv('IMAGE_MAX_PIXELS', IMAGE_MAX_PIXELS))):
+  '''Decodes an encoded screenshot straight to the size that rescaleImage would give it
+  \nThe size is read from the header first, so that images over the pixel budget are rejected before they are decoded,
+  and large images are decoded at a half, quarter or eighth of their size before the final resize.
+  The target size is computed from the size in the header, since calculateImgDimensions gives a slightly different size for the reduced image
+  \nReturns the rescaled image and the (height, width) of the screenshot. Raises ValueError if the image can not be decoded or is too large'''
+  try:
+    with Image.open(BytesIO(data)) as header:
+      width, height = header.size
+      # OpenCV applies the EXIF orientation of JPEGs, which swaps the sides of rotated images. Only check JPEGs, since Pillow decodes other formats to find their EXIF
+      if header.format in ('JPEG', 'MPO') and header.getexif().get(0x0112) in (5, 6, 7, 8):
+        width, height = height, width
+  except Exception as e:
+    raise ValueError(f'Unable to read image: {e}')
+  if width * height > maxPixels:
+    raise ValueError(f'Image is too large ({width}x{height}), the limit is {maxPixels} pixels')
+
+  dim = calculateImgDimensions(width, height)
+  # Use the largest reduction that is still at least the size of the rescaled image
+  flags = next((flags for factor, flags in REDUCED_DECODES if width // factor >= dim[0] and height // factor >= dim[1]), cv2.IMREAD_COLOR)
+  image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+  if image is None:
+    raise ValueError('Unable to decode image')
+  if image.shape[:2] != (dim[1], dim[0]):
+    image = cv2.resize(image, dim, interpolation=cv2.INTER_AREA)
+  return image, (height, width)
+
 def songTemplateFormat():
   '''Returns a formatted string of the song template'''
   songStr = f"({'|'.join(difficulties)}) song_name\n"
@@ -0,0 +1,256 @@
+# Template matching for locating the UI elements of the result screen
+import numpy as np
+import cv2
+
+import threading
+from collections import OrderedDict, defaultdict
+
+from functions import thresholdAdaptive
+from consts import MATCH_THRESHOLD, PYRAMID_SCALE, PYRAMID_MIN_SIZE, LAYOUT_CACHE_SIZE, LAYOUT_RADIUS, SPECTRUM_PAD, SPECTRUM_CACHE_BYTES, BINARY_THRESHOLD
+
+class Template:
+  '''A grayscale template image along with its downscaled copy for coarse to fine matching
+  \nThe downscaled copy is made from the image unless it was already computed'''
+  def __init__(self, image, small=None):
+    self.image = image
+    self.shape = image.shape
+    self.small = small if small is not None else cv2.resize(image, None, fx=PYRAMID_SCALE, fy=PYRAMID_SCALE, interpolation=cv2.INTER_AREA)
+
+class Frame:
+  '''A screenshot that is processed once and shared by all the stages'''
+  def __init__(self, image, resolution=None):
+    # The color screenshot that annotations are drawn on, and the grayscale copy that the templates are matched against
+    self.image = image
+    self.gray = np.ascontiguousarray(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    self.shape = self.gray.shape
+    # The (height, width) of the screenshot before it was rescaled, if known
+    self.resolution = resolution
+    # The seconds spent in each stage, and the peak match score of each named group of templates
+    self.timings = defaultdict(float)
+    self.scores = {}
+    # The boxes waiting to be drawn on the image, or None if they are drawn right away
+    self.annotations = None
+    # The fingerprint of the song title and the key of the song it matched in the title index
+    self.title = None
+    # The copies and spectral matcher sums that are only computed when first used
+    self._binary = None
+    self._small = None
+    self._float = None
+    self._spectra = {}
+    self._deviations = {}
+
+  @property
+  def binary(self):
+    if self._binary is None:
+      self._binary = thresholdAdaptive(self.gray, *BINARY_THRESHOLD)
+    return self._binary
+
+  @property
+  def small(self):
+    if self._small is None:
+      self._small = cv2.resize(self.gray, None, fx=PYRAMID_SCALE, fy=PYRAMID_SCALE, interpolation=cv2.INTER_AREA)
+    return self._small
+
+  @property
+  def float(self):
+    if self._float is None:
+      self._float = self.gray.astype(np.float32)
+    return self._float
+
+  def spectrum(self, shape):
+    '''Gets the packed DFT of the grayscale image zero padded to the given shape, for the spectral matcher'''
+    if shape not in self._spectra:
+      self._spectra[shape] = cv2.dft(cv2.copyMakeBorder(self.float, 0, shape[0] - self.shape[0], 0, shape[1] - self.shape[1], cv2.BORDER_CONSTANT, value=0))
+    return self._spectra[shape]
+
+  def deviations(self, h, w):
+    '''Gets the root sum of squared deviations of the grayscale image under each location of a template of the given size, at least 1 per pixel'''
+    if (h, w) not in self._deviations:
+      height, width = self.shape[:2]
+      total = cv2.boxFilter(self.float, -1, (w, h), anchor=(0, 0), normalize=False, borderType=cv2.BORDER_CONSTANT)[:height-h+1, :width-w+1]
+      squares = cv2.sqrBoxFilter(self.float, cv2.CV_32F, (w, h), anchor=(0, 0), normalize=False, borderType=cv2.BORDER_CONSTANT)[:height-h+1, :width-w+1]
+      self._deviations[(h, w)] = cv2.sqrt(cv2.max(cv2.scaleAdd(cv2.multiply(total, total), -1 / (h * w), squares), float(h * w)))
+    return self._deviations[(h, w)]
+
+def asFrame(image):
+  '''Wraps an image in a Frame if it is not one already'''
+  return image if isinstance(image, Frame) else Frame(image)
+
+def windowBounds(image, window, template):
+  '''Gets the pixel bounds (left, top, right, bottom) of a window given as fractions of the image
+  \nReturns None if there is no window or the template does not fit in it'''
+  if window is None:
+    return None
+  height, width = image.shape[:2]
+  h, w = template.shape[:2]
+  left, top = int(window[0] * width), int(window[1] * height)
+  right, bottom = int(np.ceil(window[2] * width)), int(np.ceil(window[3] * height))
+  if right - left < w or bottom - top < h:
+    return None
+  return left, top, right, bottom
+
+def matchRegion(image, template, bounds=None):
+  '''Matches a template inside the bounds of an image, or the whole image if there are no bounds
+  \nReturns the score and the (x, y) location of the best match in image coordinates'''
+  left, top, right, bottom = bounds if bounds is not None else (0, 0, image.shape[1], image.shape[0])
+  result = cv2.matchTemplate(image[top:bottom, left:right], template, cv2.TM_CCOEFF_NORMED)
+  y, x = np.unravel_index(np.argmax(result), result.shape)
+  return float(result[y, x]), (int(x) + left, int(y) + top)
+
+def matchPyramid(frame, template, bounds=None):
+  '''Matches a template on the downscaled frame first, then refines the match at full scale around the coarse location
+  \nReturns the score and the (x, y) location of the best match in frame coordinates'''
+  left, top, right, bottom = bounds if bounds is not None else (0, 0, frame.shape[1], frame.shape[0])
+  small = frame.small
+  h, w = template.small.shape[:2]
+  smallBounds = (int(left * PYRAMID_SCALE), int(top * PYRAMID_SCALE), int(right * PYRAMID_SCALE), int(bottom * PYRAMID_SCALE))
+  # Tiny templates lose too much detail when downscaled to be matched reliably
+  if min(h, w) < PYRAMID_MIN_SIZE or smallBounds[2] - smallBounds[0] < w or smallBounds[3] - smallBounds[1] < h:
+    return matchRegion(frame.gray, template.image, bounds)
+  _, (x, y) = matchRegion(small, template.small, smallBounds)
+
+  # Search the neighborhood of the coarse location at full scale
+  radius = int(np.ceil(1 / PYRAMID_SCALE)) + 2
+  h, w = template.shape[:2]
+  x, y = int(x / PYRAMID_SCALE), int(y / PYRAMID_SCALE)
+  refine = (max(left, x - radius), max(top, y - radius), min(right, x + w + radius), min(bottom, y + h + radius))
+  if refine[2] - refine[0] < w or refine[3] - refine[1] < h:
+    return matchRegion(frame.gray, template.image, bounds)
+  return matchRegion(frame.gray, template.image, refine)
+
+class SpectrumCache:
+  '''Bounded LRU cache of the packed DFTs of the zero mean templates per DFT shape, limited by the bytes of the spectra'''
+  def __init__(self, maxBytes=SPECTRUM_CACHE_BYTES):
+    self.maxBytes = maxBytes
+    self.bytes = 0
+    # (template id, shape) -> (template, spectrum), keeping the template so that its id is not reused
+    self.spectra = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, template, shape):
+    '''Gets the spectrum of a template at a DFT shape, computing it if it is not cached'''
+    key = (id(template), shape)
+    with self.lock:
+      if key in self.spectra:
+        self.spectra.move_to_end(key)
+        return self.spectra[key][1]
+    h, w = template.shape[:2]
+    kernel = np.zeros(shape, np.float32)
+    kernel[:h, :w] = template.image
+    kernel[:h, :w] -= kernel[:h, :w].mean()
+    spectrum = cv2.dft(kernel, nonzeroRows=h)
+    with self.lock:
+      if key not in self.spectra:
+        self.spectra[key] = (template, spectrum)
+        self.bytes += spectrum.nbytes
+      while self.bytes > self.maxBytes and len(self.spectra) > 1:
+        _, (_, evicted) = self.spectra.popitem(last=False)
+        self.bytes -= evicted.nbytes
+    return spectrum
+
+  def clear(self):
+    with self.lock:
+      self.spectra.clear()
+      self.bytes = 0
+
+# The template spectra shared by every spectral match of the process
+spectra = SpectrumCache()
+
+def matchSpectral(frame, templates, bounds):
+  '''Matches a group of templates against the frame with FFT correlation, normalized like cv2.TM_CCOEFF_NORMED
+  \nReturns for each template its (score, (x, y)) best match inside its bounds and in the whole frame'''
+  height, width = frame.shape[:2]
+  results = []
+  for template, box in zip(templates, bounds):
+    h, w = template.shape[:2]
+    norm = float(np.linalg.norm(template.image - template.image.mean()))
+    if height < h or width < w or norm == 0:
+      results.append(((-1.0, (0, 0)), (-1.0, (0, 0))))
+      continue
+
+    # Templates of the same padded size share the spectrum of the frame
+    ph, pw = -(-h // SPECTRUM_PAD) * SPECTRUM_PAD, -(-w // SPECTRUM_PAD) * SPECTRUM_PAD
+    shape = (cv2.getOptimalDFTSize(height + ph - 1), cv2.getOptimalDFTSize(width + pw - 1))
+    product = cv2.mulSpectrums(frame.spectrum(shape), spectra.get(template, shape), 0, conjB=True)
+    correlation = cv2.dft(product, flags=cv2.DFT_INVERSE | cv2.DFT_REAL_OUTPUT | cv2.DFT_SCALE)[:height-h+1, :width-w+1]
+    scores = cv2.divide(correlation, frame.deviations(h, w), scale=1 / norm)
+
+    _, score, _, location = cv2.minMaxLoc(scores)
+    whole = (float(score), location)
+    if box is None:
+      results.append((whole, whole))
+      continue
+    left, top, right, bottom = box
+    _, score, _, (x, y) = cv2.minMaxLoc(scores[top:bottom-h+1, left:right-w+1])
+    results.append(((float(score), (x + left, y + top)), whole))
+  return results
+
+def matchBest(frame, templates, window=None, threshold=MATCH_THRESHOLD, pyramid=False, spectral=False):
+  '''Finds the template that best matches the frame inside the window, or the whole frame if the window's best match scores below the threshold
+  \nReturns the index of the best template, its score and the (x, y) location of its match'''
+  if spectral:
+    matches = matchSpectral(frame, templates, [windowBounds(frame.gray, window, template) for template in templates])
+    results = [inside for inside, _ in matches]
+    if window is not None and max(score for score, _ in results) < threshold:
+      results = [whole for _, whole in matches]
+  else:
+    if pyramid:
+      search = lambda template, bounds: matchPyramid(frame, template, bounds)
+    else:
+      search = lambda template, bounds: matchRegion(frame.gray, template.image, bounds)
+    results = [search(template, windowBounds(frame.gray, window, template)) for template in templates]
+    if window is not None and max(score for score, _ in results) < threshold:
+      results = [search(template, None) for template in templates]
+  index = max(range(len(results)), key=lambda x: results[x][0])
+  score, location = results[index]
+  return index, score, location
+
+def verifyMatch(frame, templates, anchor, fixed=True, radius=LAYOUT_RADIUS, threshold=MATCH_THRESHOLD, binary=False):
+  '''Checks that the templates, or only the anchor's template if fixed, still match around a cached anchor
+  \nReturns the match like matchBest, or None if no template scores above the threshold'''
+  index, (x, y) = anchor
+  if index >= len(templates):
+    return None
+  height, width = frame.shape[:2]
+  h, w = templates[index].shape[:2]
+  image = frame.binary if binary else frame.gray
+
+  best = None
+  for i in ([index] if fixed else range(len(templates))):
+    # Templates of a different size than the anchor's can start a bit further away
+    th, tw = templates[i].shape[:2]
+    r = radius + abs(th - h) + abs(tw - w)
+    bounds = (max(0, x - r), max(0, y - r), min(width, x + tw + r), min(height, y + th + r))
+    if bounds[2] - bounds[0] < tw or bounds[3] - bounds[1] < th:
+      continue
+    score, location = matchRegion(image, templates[i].image, bounds)
+    if best is None or score > best[1]:
+      best = (i, score, location)
+  return best if best is not None and best[1] >= threshold else None
+
+class LayoutCache:
+  '''Bounded LRU cache of where each named group of templates was found, per screenshot resolution'''
+  def __init__(self, size=LAYOUT_CACHE_SIZE):
+    self.size = size
+    self.layouts = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, resolution, name):
+    '''Gets the (template index, location) anchor of a group, or None if it is not cached'''
+    with self.lock:
+      if resolution not in self.layouts:
+        return None
+      self.layouts.move_to_end(resolution)
+      return self.layouts[resolution].get(name)
+
+  def set(self, resolution, name, index, location):
+    '''Caches the anchor of a group, evicting the least recently used resolution if the cache is full'''
+    with self.lock:
+      self.layouts.setdefault(resolution, {})[name] = (index, location)
+      self.layouts.move_to_end(resolution)
+      while len(self.layouts) > self.size:
+        self.layouts.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.layouts.clear()
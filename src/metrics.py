@@ -0,0 +1,107 @@
+# Counters and latency histograms of the hot path, cheap enough to always be recording
+import threading
+import time
+from contextlib import contextmanager
+
+# The histogram buckets are powers of two in microseconds, up to about a minute
+HISTOGRAM_BUCKETS = 27
+
+class Histogram:
+  '''Latency histogram with power of two buckets, along with the count, total and max of the latencies'''
+  def __init__(self):
+    self.buckets = [0] * HISTOGRAM_BUCKETS
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def record(self, seconds):
+    # The bucket of a latency is the number of bits of its microseconds
+    self.buckets[min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+    self.count += 1
+    self.total += seconds
+    self.max = max(self.max, seconds)
+
+  def merge(self, other):
+    '''Adds the latencies of another histogram to this one'''
+    self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+    self.count += other.count
+    self.total += other.total
+    self.max = max(self.max, other.max)
+
+  def percentile(self, q):
+    '''Gets an upper bound of the q-th percentile in seconds, from the bucket that it falls in'''
+    if self.count == 0:
+      return 0.0
+    rank = q / 100 * self.count
+    seen = 0
+    for x, count in enumerate(self.buckets):
+      seen += count
+      if seen >= rank and count > 0:
+        # Bucket x holds the latencies below 2^x microseconds
+        return min(2 ** x / 1e6, self.max)
+    return self.max
+
+class Metrics:
+  '''The named counters and latency histograms of a process'''
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = {}
+    self.histograms = {}
+
+  def count(self, name, n=1):
+    '''Adds to a counter'''
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def record(self, name, seconds):
+    '''Records a latency in the histogram of the given name'''
+    with self.lock:
+      if name not in self.histograms:
+        self.histograms[name] = Histogram()
+      self.histograms[name].record(seconds)
+
+  @contextmanager
+  def timer(self, name):
+    '''Records the time spent in the block in the histogram of the given name'''
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.record(name, time.perf_counter() - start)
+
+  def drain(self):
+    '''Takes the counters and histograms recorded so far, resetting them'''
+    with self.lock:
+      counters, histograms = self.counters, self.histograms
+      self.counters, self.histograms = {}, {}
+    return counters, histograms
+
+  def merge(self, drained):
+    '''Adds the counters and histograms drained from another process'''
+    counters, histograms = drained
+    with self.lock:
+      for name, n in counters.items():
+        self.counters[name] = self.counters.get(name, 0) + n
+      for name, histogram in histograms.items():
+        if name not in self.histograms:
+          self.histograms[name] = Histogram()
+        self.histograms[name].merge(histogram)
+
+  def reset(self):
+    self.drain()
+
+  def summary(self):
+    '''Gets a summary of the counters and histograms recorded so far, see summarize'''
+    with self.lock:
+      return summarize((self.counters, self.histograms))
+
+def summarize(drained):
+  '''Gets a summary of drained counters and histograms, with the count, mean and percentiles of each histogram'''
+  counters, histograms = drained
+  lines = [f'{name}: {n}' for name, n in sorted(counters.items())]
+  for name, h in sorted(histograms.items()):
+    lines.append(f'{name}: n={h.count} mean={h.total * 1000 / h.count:.1f}ms p50<={h.percentile(50) * 1000:.1f}ms p90<={h.percentile(90) * 1000:.1f}ms p99<={h.percentile(99) * 1000:.1f}ms max={h.max * 1000:.1f}ms')
+  return '\n'.join(lines) if lines else 'No metrics recorded'
+
+# The metrics of the current process
+metrics = Metrics()
@@ -0,0 +1,254 @@
+# OCR backends for reading the text of the ROIs
+import numpy as np
+import pytesseract
+
+import logging
+import multiprocessing
+import queue
+import threading
+
+from metrics import metrics
+from consts import OCR_BACKEND, OCR_WORKER_TIMEOUT, STAGE_THREADS
+
+# tesserocr keeps Tesseract loaded in memory, but it is optional
+try:
+  import tesserocr
+except ImportError:
+  tesserocr = None
+
+def parseConfig(config):
+  '''Parses a pytesseract config string into the page segmentation mode and the config files it uses'''
+  args = config.split()
+  psm = int(args[args.index('--psm') + 1]) if '--psm' in args else 3
+  configs = [arg for x, arg in enumerate(args) if not arg.startswith('-') and (x == 0 or args[x-1] != '--psm')]
+  return psm, configs
+
+def readData(api):
+  '''Reads the words of the current image of a tesserocr API in the format of pytesseract.image_to_data'''
+  data = { key: [] for key in ['text', 'left', 'top', 'width', 'height', 'conf', 'block_num', 'par_num', 'line_num'] }
+  api.Recognize()
+  iterator = api.GetIterator()
+  if iterator is None:
+    return data
+
+  level = tesserocr.RIL.WORD
+  block, par, line = 0, 0, 0
+  for word in tesserocr.iterate_level(iterator, level):
+    # Keep track of the block, paragraph and line that the word is in
+    if word.IsAtBeginningOf(tesserocr.RIL.BLOCK):
+      block, par, line = block + 1, 0, 0
+    if word.IsAtBeginningOf(tesserocr.RIL.PARA):
+      par, line = par + 1, 0
+    if word.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+      line += 1
+    box = word.BoundingBox(level)
+    if box is None:
+      continue
+    data['text'].append(word.GetUTF8Text(level))
+    data['left'].append(box[0])
+    data['top'].append(box[1])
+    data['width'].append(box[2] - box[0])
+    data['height'].append(box[3] - box[1])
+    data['conf'].append(word.Confidence(level))
+    data['block_num'].append(block)
+    data['par_num'].append(par)
+    data['line_num'].append(line)
+  return data
+
+def workerLoop(conn, config):
+  '''Main loop of a recognizer worker, reading the images sent over the pipe with Tesseract kept loaded'''
+  psm, configs = parseConfig(config)
+  api = tesserocr.PyTessBaseAPI(init=False)
+  api.InitFull(configs=configs)
+  api.SetPageSegMode(psm)
+  # Tell the parent process that Tesseract is loaded
+  conn.send(True)
+
+  while True:
+    message = conn.recv()
+    if message is None:
+      break
+    kind, image = message
+    api.SetImageBytes(image.tobytes(), image.shape[1], image.shape[0], 1, image.shape[1])
+    conn.send(api.GetUTF8Text() if kind == 'string' else readData(api))
+  api.End()
+
+class PytesseractBackend:
+  '''OCR backend that runs a new tesseract process for every call'''
+  def imageToString(self, image, config):
+    return pytesseract.image_to_string(image, config=config)
+
+  def imageToData(self, image, config):
+    return pytesseract.image_to_data(image, config=config, output_type=pytesseract.Output.DICT)
+
+  def close(self):
+    pass
+
+class RecognizerWorker:
+  '''A long-lived process that keeps Tesseract loaded with a single config'''
+  def __init__(self, config):
+    self.config = config
+    self.lock = threading.Lock()
+    self.conn, child = multiprocessing.Pipe()
+    self.process = multiprocessing.Process(target=workerLoop, args=(child, config), daemon=True)
+    self.process.start()
+    child.close()
+    # Wait for Tesseract to be loaded before using the worker
+    if not self.conn.poll(OCR_WORKER_TIMEOUT) or not self.conn.recv():
+      raise RuntimeError(f'Recognizer worker for "{config}" did not start')
+
+  def read(self, kind, image):
+    '''Reads an image with the worker, where kind is either "string" or "data"'''
+    with self.lock:
+      self.conn.send((kind, np.ascontiguousarray(image, dtype=np.uint8)))
+      if not self.conn.poll(OCR_WORKER_TIMEOUT):
+        raise TimeoutError(f'Recognizer worker for "{self.config}" timed out')
+      return self.conn.recv()
+
+  def close(self):
+    try:
+      self.conn.send(None)
+    except (OSError, EOFError):
+      pass
+    self.process.join(1)
+    if self.process.is_alive():
+      self.process.kill()
+
+class WorkerPool:
+  '''Recognizer workers that share a config, so that the stages reading with the same config at once do not wait on each other
+  \nThe workers are only started when every started worker is busy, up to the size of the pool'''
+  def __init__(self, config, size):
+    self.config = config
+    self.size = size
+    self.workers = []
+    self.idle = queue.Queue()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    '''Takes an idle worker, starting a new one if there is none and the pool is not full, otherwise waiting for one'''
+    try:
+      return self.idle.get_nowait()
+    except queue.Empty:
+      pass
+    with self.lock:
+      if len(self.workers) < self.size:
+        worker = RecognizerWorker(self.config)
+        self.workers.append(worker)
+        return worker
+    return self.idle.get()
+
+  def release(self, worker):
+    self.idle.put(worker)
+
+  def close(self):
+    with self.lock:
+      for worker in self.workers:
+        worker.close()
+      self.workers = []
+
+class WorkerBackend:
+  '''OCR backend that feeds the ROIs to long-lived recognizer workers, with a pool of up to size workers per config
+  \nFalls back to pytesseract when the workers of a config are unavailable'''
+  def __init__(self, size=STAGE_THREADS):
+    self.size = size
+    self.pools = {}
+    self.lock = threading.Lock()
+    self.fallback = PytesseractBackend()
+
+  def getPool(self, config):
+    '''Gets the worker pool of a config, creating it if needed. Returns None if the workers are unavailable'''
+    with self.lock:
+      if config not in self.pools:
+        self.pools[config] = WorkerPool(config, self.size) if tesserocr else None
+      return self.pools[config]
+
+  def disable(self, config):
+    '''Stops using the workers of a config, falling back to pytesseract for it'''
+    with self.lock:
+      pool = self.pools.get(config)
+      self.pools[config] = None
+    if pool is not None:
+      pool.close()
+
+  def read(self, kind, image, config):
+    pool = self.getPool(config)
+    if pool is not None:
+      try:
+        worker = pool.acquire()
+      except Exception as e:
+        logging.warning(f'OCR: Unable to start recognizer worker for "{config}", falling back to pytesseract: {e}')
+        self.disable(config)
+      else:
+        try:
+          res = worker.read(kind, image)
+        except (OSError, EOFError, TimeoutError) as e:
+          # Stop using the workers of the config if one died or hung
+          logging.warning(f'OCR: Recognizer worker for "{config}" is unavailable, falling back to pytesseract: {e}')
+          self.disable(config)
+        else:
+          pool.release(worker)
+          return res
+    if kind == 'string':
+      return self.fallback.imageToString(image, config)
+    return self.fallback.imageToData(image, config)
+
+  def imageToString(self, image, config):
+    return self.read('string', image, config)
+
+  def imageToData(self, image, config):
+    return self.read('data', image, config)
+
+  def close(self):
+    with self.lock:
+      for pool in self.pools.values():
+        if pool is not None:
+          pool.close()
+      self.pools = {}
+
+class CountingBackend:
+  '''OCR backend wrapper that counts the calls made to the backend it wraps, for benchmarking'''
+  def __init__(self, backend):
+    self.backend = backend
+    self.calls = 0
+
+  def imageToString(self, image, config):
+    self.calls += 1
+    return self.backend.imageToString(image, config)
+
+  def imageToData(self, image, config):
+    self.calls += 1
+    return self.backend.imageToData(image, config)
+
+  def close(self):
+    self.backend.close()
+
+class MeteredBackend:
+  '''OCR backend wrapper that records the latency of every call in the metrics, per config'''
+  def __init__(self, backend):
+    self.backend = backend
+
+  def imageToString(self, image, config):
+    with metrics.timer(f'ocr {config}'):
+      return self.backend.imageToString(image, config)
+
+  def imageToData(self, image, config):
+    with metrics.timer(f'ocr {config}'):
+      return self.backend.imageToData(image, config)
+
+  def close(self):
+    self.backend.close()
+
+# Whether the missing tesserocr was already warned about in this process
+warnedTesserocr = False
+
+def createBackend(name=OCR_BACKEND):
+  '''Creates an OCR backend given its name, either "workers" or "pytesseract", using pytesseract if the workers can not be used'''
+  global warnedTesserocr
+  if name == 'workers' and tesserocr is None:
+    if not warnedTesserocr:
+      logging.warning('OCR: The workers backend needs tesserocr, which is not installed, falling back to pytesseract')
+      warnedTesserocr = True
+    name = 'pytesseract'
+  if name == 'workers':
+    return WorkerBackend()
+  return PytesseractBackend()
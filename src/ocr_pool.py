@@ -0,0 +1,151 @@
+# Process pool for running the OCR off of the bot's event loop
+import asyncio
+import logging
+import multiprocessing
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+
+from api import ScoreAPI
+from functions import decodeImage
+from metrics import metrics
+from result_cache import ResultCache
+from title_index import TitleIndex
+from consts import OCR_WORKERS, BESTDORI_TIMEOUT
+
+# The ScoreAPI of the current worker process
+scoreAPI: ScoreAPI = None
+
+def bestdoriSongData():
+  '''Gets a function from a song name to its Bestdori song data for checking the results of the tiered pipeline, or None if Bestdori is unavailable'''
+  from bestdori import BestdoriAPI, getSong
+  try:
+    bestdori = BestdoriAPI()
+  except Exception as e:
+    logging.warning(f'OCR: Unable to load the Bestdori songs, results will not be checked against them: {e}')
+    return None
+
+  # Cached by the key of the song rather than the name read, and failed fetches are not cached so that they are tried again
+  @lru_cache(maxsize=128)
+  def fetchSong(key):
+    return getSong(key, timeout=BESTDORI_TIMEOUT)
+
+  def songData(songName):
+    # The song is found in the songs that are already loaded, only its data is fetched
+    key, _, _ = bestdori.getSong(songName, songInfo=False)
+    if not key:
+      return None
+    try:
+      return fetchSong(key)
+    except Exception as e:
+      logging.warning(f'OCR: Unable to fetch the Bestdori data of song {key}, the result will not be checked against it: {e}')
+      return None
+  return songData
+
+def initWorker(mode, draw, tiered=False, parallel=False, titlesPath=None):
+  '''Creates the ScoreAPI of a worker process so that the templates are only loaded once per worker'''
+  global scoreAPI
+  titles = TitleIndex(titlesPath) if titlesPath is not None else None
+  scoreAPI = ScoreAPI(mode, draw, tiered=tiered, songData=bestdoriSongData() if tiered else None, parallel=parallel, titles=titles)
+
+def getSongInfo(image, resolution=None):
+  '''Gets the song information from an image using the ScoreAPI of the worker process, see ScoreAPI.getSongInfo
+  \nAlso returns the fingerprint of the song title, and the metrics drained from the worker for the parent process to aggregate'''
+  title = {}
+  res = scoreAPI.getSongInfo(image, title=title, resolution=resolution)
+  return res, title.get('fingerprint'), metrics.drain()
+
+def readImage(data):
+  '''Decodes and reads an encoded image using the ScoreAPI of the worker process
+  \nReturns the JSON record of the image with the fields of the SongInfo or the error, and the milliseconds spent in each stage'''
+  record = {}
+  timings = {}
+  start = time.perf_counter()
+  try:
+    image, resolution = decodeImage(data)
+    timings['decode'] = time.perf_counter() - start
+    songInfo, _ = scoreAPI.getSongInfo(image, timings, resolution=resolution)
+    record.update(songInfo.toDict())
+  except Exception as e:
+    record['error'] = str(e)
+  timings['total'] = time.perf_counter() - start
+  record['timings'] = { key: round(value * 1000, 3) for key, value in timings.items() }
+  return record
+
+def readImages(blobs):
+  '''Reads a batch of encoded images in one round trip to the worker process
+  \nReturns the record of each image and the metrics drained from the worker'''
+  return [readImage(data) for data in blobs], metrics.drain()
+
+class OCRPool:
+  '''Pool of worker processes that each hold their own ScoreAPI
+  \nIf a result cache is given, screenshots that were already read are not read again.
+  If a title index is given, the workers look the song titles up in it, and confirmTitle adds the titles that users confirmed to it'''
+  def __init__(self, workers=OCR_WORKERS, mode='cropped', draw=False, cache: ResultCache = None, tiered=False, parallel=False, titles: TitleIndex = None):
+    self.workers = workers
+    self.cache = cache
+    self.titles = titles
+    # The title fingerprint of each SongInfo read, until it is confirmed
+    self.fingerprints = weakref.WeakKeyDictionary()
+    self.initargs = (mode, draw, tiered, parallel, titles.path if titles is not None else None)
+    self.executor = self.createExecutor()
+
+  def createExecutor(self):
+    '''Creates the process pool of the workers'''
+    # Spawn the workers instead of forking the bot process and its running event loop
+    return ProcessPoolExecutor(
+      max_workers=self.workers,
+      mp_context=multiprocessing.get_context('spawn'),
+      initializer=initWorker,
+      initargs=self.initargs
+    )
+
+  async def run(self, fn, *args):
+    '''Runs a function on a worker without blocking the event loop, restarting the workers and trying once more if one of them died'''
+    loop = asyncio.get_running_loop()
+    executor = self.executor
+    try:
+      return await loop.run_in_executor(executor, fn, *args)
+    except BrokenProcessPool as e:
+      # Only replace the pool if another call did not already replace it
+      if self.executor is executor:
+        logging.warning(f'OCR: A worker process died, restarting the workers: {e}')
+        metrics.count('pool restart')
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = self.createExecutor()
+      return await loop.run_in_executor(self.executor, fn, *args)
+
+  async def getSongInfo(self, image, resolution=None):
+    '''Gets the song information from an image without blocking the event loop
+    \nIf a resolution is given, the image was already rescaled by decodeImage'''
+    if self.cache is not None:
+      cached = self.cache.get(image)
+      if cached is not None:
+        return cached
+    res, fingerprint, drained = await self.run(getSongInfo, image, resolution)
+    metrics.merge(drained)
+    if fingerprint is not None:
+      self.fingerprints[res[0]] = fingerprint
+    if self.cache is not None:
+      self.cache.set(image, *res)
+    return res
+
+  def confirmTitle(self, songInfo, key, songName):
+    '''Adds the title fingerprint of a SongInfo read by the pool to the title index, once the user confirmed which song it is'''
+    fingerprint = self.fingerprints.pop(songInfo, None)
+    if self.titles is not None and fingerprint is not None:
+      self.titles.add(fingerprint, key, songName)
+
+  async def readImages(self, blobs):
+    '''Reads a batch of encoded images on one worker without blocking the event loop, see readImage'''
+    records, drained = await self.run(readImages, blobs)
+    metrics.merge(drained)
+    return records
+
+  def shutdown(self, wait=True):
+    '''Shuts down the worker processes and saves the result cache'''
+    self.executor.shutdown(wait=wait, cancel_futures=True)
+    if self.cache is not None:
+      self.cache.save()
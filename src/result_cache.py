@@ -0,0 +1,96 @@
+# Cache of the song information of screenshots that were already read, keyed by a perceptual hash
+import numpy as np
+import cv2
+
+import copy
+import logging
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+from metrics import metrics
+from consts import RESULT_CACHE_SIZE, RESULT_HASH_DISTANCE, RESULT_THUMB_SIZE, RESULT_DIFF_THRESHOLD
+
+def thumbnail(image):
+  '''Gets the small grayscale copy of a screenshot that cached results are compared with'''
+  gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+  return cv2.resize(gray, RESULT_THUMB_SIZE, interpolation=cv2.INTER_AREA)
+
+def differenceHash(thumb):
+  '''Gets the 64 bit difference hash of a thumbnail, where each bit is whether a pixel is brighter than its right neighbor on a 9x8 grid'''
+  small = cv2.resize(thumb, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+  return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), 'big')
+
+def hammingDistance(a, b):
+  return bin(a ^ b).count('1')
+
+def sameScreenshot(a, b):
+  '''Checks that two thumbnails are the same screenshot, up to the noise of being encoded again
+  \nResult screens of the same song only differ in a few digits, so any local difference rejects the match'''
+  return cv2.blur(cv2.absdiff(a, b), (5, 5)).max() <= RESULT_DIFF_THRESHOLD
+
+class ResultCache:
+  '''LRU cache of the SongInfo and annotated image of screenshots, so that re-posted screenshots are not read again
+  \nScreenshots are looked up by the exact hash first, then by the nearest hash within RESULT_HASH_DISTANCE, and every hit is checked against the thumbnail of the cached screenshot.
+  If a path is given, the cache is loaded from it and saved to it with save'''
+  def __init__(self, size=RESULT_CACHE_SIZE, path=None):
+    self.size = size
+    self.path = path
+    self.lock = threading.Lock()
+    # Hash -> (thumbnail, SongInfo, JPEG of the annotated image)
+    self.entries = OrderedDict()
+    if path is not None and os.path.exists(path):
+      try:
+        with open(path, 'rb') as f:
+          self.entries = pickle.load(f)
+      except Exception as e:
+        logging.warning(f'Result cache: Unable to load {path}: {e}')
+
+  def lookup(self, thumb, hash):
+    '''Finds the hash of the cached screenshot that a thumbnail is the same as, or None'''
+    if hash in self.entries and sameScreenshot(thumb, self.entries[hash][0]):
+      return hash
+    near = sorted((hammingDistance(hash, key), key) for key in self.entries if key != hash)
+    for distance, key in near:
+      if distance > RESULT_HASH_DISTANCE:
+        break
+      if sameScreenshot(thumb, self.entries[key][0]):
+        return key
+    return None
+
+  def get(self, image):
+    '''Gets a copy of the SongInfo and annotated image cached for a screenshot, or None if it was not read before'''
+    thumb = thumbnail(image)
+    hash = differenceHash(thumb)
+    with self.lock:
+      key = self.lookup(thumb, hash)
+      if key is None:
+        metrics.count('result cache miss')
+        return None
+      self.entries.move_to_end(key)
+      _, songInfo, encoded = self.entries[key]
+    metrics.count('result cache hit')
+    # Return copies so that editing the result does not edit the cache
+    return copy.deepcopy(songInfo), cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+
+  def set(self, image, songInfo, res):
+    '''Caches the SongInfo and annotated image read from a screenshot'''
+    thumb = thumbnail(image)
+    hash = differenceHash(thumb)
+    encoded = cv2.imencode('.jpg', res)[1]
+    with self.lock:
+      self.entries[hash] = (thumb, copy.deepcopy(songInfo), encoded)
+      self.entries.move_to_end(hash)
+      while len(self.entries) > self.size:
+        self.entries.popitem(last=False)
+
+  def save(self):
+    '''Saves the cache to its path, if it has one'''
+    if self.path is None:
+      return
+    with self.lock:
+      entries = OrderedDict(self.entries)
+    with open(f'{self.path}.tmp', 'wb') as f:
+      pickle.dump(entries, f)
+    os.replace(f'{self.path}.tmp', self.path)
@@ -0,0 +1,163 @@
+# HTTP service for reading the song information of screenshots, so that the bots and the batch tools can share warm OCR workers
+import os
+os.environ["OPENCV_LOG_LEVEL"]="SILENT"
+
+import argparse
+import asyncio
+import logging
+import time
+
+from aiohttp import web
+
+from ocr_pool import OCRPool
+from title_index import TitleIndex
+from metrics import metrics
+from consts import OCR_WORKERS, OCR_TIERED, OCR_PARALLEL, SERVER_PORT, SERVER_BATCH_SIZE, SERVER_BATCH_WAIT, SERVER_QUEUE_SIZE, SERVER_MAX_UPLOAD
+
+class BatchQueue:
+  '''Queue of uploaded images that are read in micro-batches on the worker pool
+  \nA batch is sent once it has batchSize images or batchWait seconds have passed since its first image, with at most one batch per worker in flight.
+  Images keep queueing up while every worker is busy, so batches grow with the load'''
+  def __init__(self, pool: OCRPool, batchSize=SERVER_BATCH_SIZE, batchWait=SERVER_BATCH_WAIT, queueSize=SERVER_QUEUE_SIZE):
+    self.pool = pool
+    self.batchSize = batchSize
+    self.batchWait = batchWait
+    self.queue = asyncio.Queue(queueSize)
+    self.slots = asyncio.Semaphore(pool.workers)
+    self.batches = set()
+    self.task = None
+
+  def start(self):
+    self.task = asyncio.create_task(self.run())
+
+  async def stop(self):
+    self.task.cancel()
+    await asyncio.gather(self.task, *self.batches, return_exceptions=True)
+
+  def submit(self, data):
+    '''Queues an encoded image, returning the future of its record. Raises asyncio.QueueFull if the queue is full'''
+    future = asyncio.get_running_loop().create_future()
+    self.queue.put_nowait((data, future, time.perf_counter()))
+    return future
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      # Wait for a free worker before starting a batch
+      await self.slots.acquire()
+      batch = [await self.queue.get()]
+      deadline = loop.time() + self.batchWait
+      while len(batch) < self.batchSize:
+        try:
+          batch.append(self.queue.get_nowait())
+          continue
+        except asyncio.QueueEmpty:
+          pass
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+      task = asyncio.create_task(self.readBatch(batch))
+      self.batches.add(task)
+      task.add_done_callback(self.batches.discard)
+
+  async def readBatch(self, batch):
+    '''Reads a batch on the worker pool and resolves the future of each of its images'''
+    # Skip the images whose request was cancelled while they were queued
+    batch = [item for item in batch if not item[1].done()]
+    if not batch:
+      self.slots.release()
+      return
+    start = time.perf_counter()
+    metrics.count('server batches')
+    metrics.count('server images', len(batch))
+    try:
+      records = await self.pool.readImages([data for data, _, _ in batch])
+      for (_, future, queued), record in zip(batch, records):
+        record['timings']['queue'] = round((start - queued) * 1000, 3)
+        # The client may have gone away while the image was being read
+        if not future.done():
+          future.set_result(record)
+    except Exception as e:
+      for _, future, _ in batch:
+        if not future.done():
+          future.set_exception(e)
+    finally:
+      self.slots.release()
+
+async def readUploads(request: web.Request):
+  '''Gets the (name, data) of the images of a request, either the files of a multipart form or the raw body'''
+  if request.content_type.startswith('multipart/'):
+    uploads = []
+    reader = await request.multipart()
+    async for part in reader:
+      if part.filename:
+        uploads.append((part.filename, await part.read()))
+    return uploads
+  return [(None, await request.read())]
+
+async def songInfo(request: web.Request):
+  '''Reads the song information of the uploaded screenshots
+  \nResponds with a record per image with the fields of its SongInfo or its error, and the milliseconds spent in each stage'''
+  queue: BatchQueue = request.app['queue']
+  uploads = await readUploads(request)
+  if not uploads or not all(data for _, data in uploads):
+    raise web.HTTPBadRequest(text='No image uploaded')
+
+  futures = []
+  try:
+    for _, data in uploads:
+      futures.append(queue.submit(data))
+  except asyncio.QueueFull:
+    metrics.count('server rejected')
+    # Skip the images of the request that were already queued
+    for future in futures:
+      future.cancel()
+    raise web.HTTPServiceUnavailable(text='Too many images queued, try again later', headers={ 'Retry-After': '1' })
+  records = await asyncio.gather(*futures)
+
+  for (name, _), record in zip(uploads, records):
+    if name is not None:
+      record['file'] = name
+  return web.json_response({ 'results': records })
+
+async def health(request: web.Request):
+  queue: BatchQueue = request.app['queue']
+  return web.json_response({ 'status': 'ok', 'workers': queue.pool.workers, 'queued': queue.queue.qsize() })
+
+async def metricsSummary(request: web.Request):
+  return web.Response(text=metrics.summary())
+
+def createApp(workers=OCR_WORKERS, mode='cropped'):
+  '''Creates the OCR service, which starts its worker pool when the app starts'''
+  app = web.Application(client_max_size=SERVER_MAX_UPLOAD)
+  app.router.add_post('/songinfo', songInfo)
+  app.router.add_get('/health', health)
+  app.router.add_get('/metrics', metricsSummary)
+
+  async def startup(app):
+    app['pool'] = OCRPool(workers, mode, tiered=OCR_TIERED, parallel=OCR_PARALLEL, titles=TitleIndex())
+    app['queue'] = BatchQueue(app['pool'])
+    app['queue'].start()
+
+  async def cleanup(app):
+    await app['queue'].stop()
+    app['pool'].shutdown(wait=False)
+
+  app.on_startup.append(startup)
+  app.on_cleanup.append(cleanup)
+  return app
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='HTTP service that reads the song information of screenshots')
+  parser.add_argument('--host', default='0.0.0.0', help='Host to listen on')
+  parser.add_argument('-p', '--port', type=int, default=int(os.getenv('PORT', SERVER_PORT)), help='Port to listen on')
+  parser.add_argument('-w', '--workers', type=int, default=int(os.getenv('OCR_WORKERS', OCR_WORKERS)), help='Number of worker processes')
+  parser.add_argument('--mode', default='cropped', help='Asset mode of the templates')
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO)
+  web.run_app(createApp(args.workers, args.mode), host=args.host, port=args.port)
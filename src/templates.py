@@ -0,0 +1,151 @@
+# Loading the templates of an asset mode, either from the assets or from a compiled bundle
+import numpy as np
+import cv2
+
+import glob
+import json
+import os
+import sys
+
+from functions import ASSETS_DIR, thresholdAdaptive, fetchRanks, fetchNoteTypes, fetchDifficulties, fetchScoreIcon, fetchMaxCombo, fetchFastSlow
+from matching import Template
+from digits import descriptor
+from consts import noteTypes, PYRAMID_SCALE, RANK_GLYPH_SIZE, BINARY_THRESHOLD
+
+def bundlePaths(mode):
+  '''Gets the paths of the array and index files of the template bundle of a mode'''
+  return f'{ASSETS_DIR}/{mode}.templates.npy', f'{ASSETS_DIR}/{mode}.templates.json'
+
+def fetchTemplates(mode):
+  '''Fetches the templates of a mode from the assets, preparing the downscaled copies for the pyramid matcher'''
+  return {
+    'ranks': [(Template(template), rank) for template, rank in fetchRanks(mode)],
+    'noteTypes': { type: [(Template(template), noteType) for template, noteType in value] for type, value in fetchNoteTypes(mode).items() },
+    'difficulties': [(Template(template), difficulty) for template, difficulty in fetchDifficulties(mode)],
+    'scoreIcon': Template(fetchScoreIcon(mode)),
+    'maxCombo': tuple(Template(template) for template in fetchMaxCombo(mode)),
+    'fastSlow': tuple(Template(template) for template in fetchFastSlow(mode))
+  }
+
+def listTemplates(templates):
+  '''Lists the templates of a mode as (group, name, template) in the order they are stored in'''
+  res = [('ranks', rank, template) for template, rank in templates['ranks']]
+  res += [('noteTypes', key, template) for value in templates['noteTypes'].values() for template, noteType in value for key in noteTypes if noteTypes[key] is noteType]
+  res += [('difficulties', difficulty, template) for template, difficulty in templates['difficulties']]
+  res += [('scoreIcon', 0, templates['scoreIcon'])]
+  res += [('maxCombo', x, template) for x, template in enumerate(templates['maxCombo'])]
+  res += [('fastSlow', x, template) for x, template in enumerate(templates['fastSlow'])]
+  return res
+
+def compileTemplates(mode):
+  '''Compiles the templates of a mode into a bundle of one flat array with a JSON index, which can be memory mapped'''
+  arrayPath, indexPath = bundlePaths(mode)
+  images, index, offset = [], [], 0
+  for group, name, template in listTemplates(fetchTemplates(mode)):
+    entry = { 'group': group, 'name': name }
+    # Store the grayscale template and its downscaled copy one after the other
+    for key, image in [('image', template.image), ('small', template.small)]:
+      entry[key] = [offset, *image.shape]
+      images.append(image.ravel())
+      offset += image.size
+    index.append(entry)
+
+  np.save(arrayPath, np.concatenate(images))
+  with open(indexPath, 'w') as f:
+    json.dump({ 'scale': PYRAMID_SCALE, 'templates': index }, f)
+  return len(index)
+
+def isBundleCurrent(mode):
+  '''Checks that the bundle of a mode exists, is newer than its assets and was compiled with the current pyramid scale'''
+  arrayPath, indexPath = bundlePaths(mode)
+  if not os.path.exists(arrayPath) or not os.path.exists(indexPath):
+    return False
+  compiled = min(os.path.getmtime(arrayPath), os.path.getmtime(indexPath))
+  assets = [os.path.getmtime(path) for path in glob.glob(f'{ASSETS_DIR}/{mode}/**/*.*', recursive=True)]
+  if assets and max(assets) > compiled:
+    return False
+  with open(indexPath, 'r') as f:
+    return json.load(f)['scale'] == PYRAMID_SCALE
+
+def loadBundle(mode):
+  '''Loads the templates of a mode from its bundle without copying them, so that processes share the pages of the bundle'''
+  arrayPath, indexPath = bundlePaths(mode)
+  array = np.load(arrayPath, mmap_mode='r')
+  with open(indexPath, 'r') as f:
+    index = json.load(f)['templates']
+
+  def view(offset, h, w):
+    return array[offset:offset + h * w].reshape(h, w)
+
+  templates = { 'ranks': [], 'noteTypes': {}, 'difficulties': [], 'maxCombo': [], 'fastSlow': [] }
+  for entry in index:
+    group, name = entry['group'], entry['name']
+    template = Template(view(*entry['image']), view(*entry['small']))
+    if group == 'noteTypes':
+      templates['noteTypes'].setdefault(noteTypes[name]['type'], []).append((template, noteTypes[name]))
+    elif group in ['ranks', 'difficulties']:
+      templates[group].append((template, name))
+    elif group == 'scoreIcon':
+      templates['scoreIcon'] = template
+    else:
+      templates[group].append(template)
+  templates['maxCombo'] = tuple(templates['maxCombo'])
+  templates['fastSlow'] = tuple(templates['fastSlow'])
+  return templates
+
+def badgeTemplate(difficulties):
+  '''Makes the template of the difficulty badge that matches every difficulty, by averaging the difficulty templates'''
+  h = min(template.shape[0] for template, _ in difficulties)
+  w = min(template.shape[1] for template, _ in difficulties)
+  mean = np.mean([template.image[:h, :w].astype(np.float32) for template, _ in difficulties], axis=0)
+  return Template(np.ascontiguousarray(mean.astype(np.uint8)))
+
+def rankBadgeTemplate(ranks):
+  '''Makes the black and white template of the rank badge that matches every rank, by averaging the binarized rank templates centered in the size of the largest one
+  \nThe templates are binarized like the black and white frame that the badge is matched against, then normalized to zero mean before they are averaged,
+  so that the padding around the narrow ranks is neutral to the correlation'''
+  h = max(template.shape[0] for template, _ in ranks)
+  w = max(template.shape[1] for template, _ in ranks)
+  def center(image):
+    image = thresholdAdaptive(image, *BINARY_THRESHOLD).astype(np.float32)
+    image = (image - image.mean()) / (image.std() or 1)
+    top, left = (h - image.shape[0]) // 2, (w - image.shape[1]) // 2
+    return cv2.copyMakeBorder(image, top, h - image.shape[0] - top, left, w - image.shape[1] - left, cv2.BORDER_CONSTANT, value=0)
+  mean = np.mean([center(template.image) for template, _ in ranks], axis=0)
+  mean = np.clip(128 + mean * 127 / max(np.abs(mean).max(), 1e-6), 0, 255)
+  return Template(np.ascontiguousarray(mean.astype(np.uint8)))
+
+def rankGlyph(gray):
+  '''Gets the descriptor and the (x, y, w, h) bounding box of the rank glyph in a grayscale crop around the rank badge, or None if there is no glyph
+  \nThe dark outline of the glyph is binarized with Otsu's threshold, leaving out what touches the edges of the crop, then cropped to its bounding box and downsampled to RANK_GLYPH_SIZE'''
+  if gray.size == 0 or gray.min() == gray.max():
+    return None
+  _, bw = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+  n, labels, stats, _ = cv2.connectedComponentsWithStats(bw, connectivity=8)
+  h, w = bw.shape
+  inside = [i for i in range(1, n) if stats[i, 0] > 0 and stats[i, 1] > 0 and stats[i, 0] + stats[i, 2] < w and stats[i, 1] + stats[i, 3] < h]
+  if not inside:
+    return None
+  fg = np.isin(labels, inside)
+  ys, xs = np.nonzero(fg)
+  x, y = int(xs.min()), int(ys.min())
+  box = fg[y:ys.max()+1, x:xs.max()+1].astype(np.float32)
+  return descriptor(cv2.resize(box, RANK_GLYPH_SIZE, interpolation=cv2.INTER_AREA)), (x, y, box.shape[1], box.shape[0])
+
+def rankGlyphs(ranks):
+  '''Gets the descriptors of the rank glyphs as the rows of a matrix, so that a glyph is compared with every rank in one product
+  \nThe rank templates are padded with white like the light result screen around the rank badge'''
+  return np.stack([rankGlyph(cv2.copyMakeBorder(template.image, 4, 4, 4, 4, cv2.BORDER_CONSTANT, value=255))[0] for template, _ in ranks])
+
+def loadTemplates(mode):
+  '''Loads the templates of a mode from its bundle if it is current, otherwise from the assets'''
+  templates = loadBundle(mode) if isBundleCurrent(mode) else fetchTemplates(mode)
+  templates['difficultyBadge'] = badgeTemplate(templates['difficulties'])
+  templates['rankBadge'] = rankBadgeTemplate(templates['ranks'])
+  templates['rankGlyphs'] = rankGlyphs(templates['ranks'])
+  return templates
+
+if __name__ == '__main__':
+  # Compile the bundles of the given modes
+  for mode in sys.argv[1:] or ['cropped']:
+    print(f'{mode}: compiled {compileTemplates(mode)} templates')
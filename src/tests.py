@@ -8,6 +8,7 @@ os.environ["OPENCV_LOG_LEVEL"]="SILENT"
 
 import cv2
 import glob
+import numpy as np
 from api import *
 from functions import *
 import matplotlib.pyplot as plt
@@ -29,6 +30,67 @@ def testDir(path):
     print("---")
     print(songInfoToStr(song))
 
+def testBatchOCR(path):
+  '''Test that batched OCR reads the same fields as per-field OCR on a directory of images'''
+  scoreAPI = ScoreAPI()
+  batchAPI = ScoreAPI(batchOCR=True)
+
+  mismatches = 0
+  for file in glob.glob(f"testdata/{path}/*.jpg"):
+    image = cv2.imread(file)
+    expected, _ = scoreAPI.getSongInfo(image)
+    actual, _ = batchAPI.getSongInfo(image)
+    fields = [key for key in vars(expected) if vars(expected)[key] != vars(actual)[key]]
+    if fields:
+      mismatches += 1
+      print(f"{file}: {', '.join(f'{key} ({vars(expected)[key]} != {vars(actual)[key]})' for key in fields)}")
+  print(f"{mismatches} image(s) with mismatched fields")
+
+def testTiered(path):
+  '''Test that the tiered pipeline reads the same fields as the full pipeline on a directory of images, and how many fields it escalated'''
+  scoreAPI = ScoreAPI()
+  tieredAPI = ScoreAPI(tiered=True)
+
+  mismatches = 0
+  for file in glob.glob(f"testdata/{path}/*.jpg"):
+    image = cv2.imread(file)
+    expected, _ = scoreAPI.getSongInfo(image)
+    actual, confidences = tieredAPI.getSongInfoTiered(Frame(rescaleImage(image), image.shape[:2]))
+    fields = [key for key in vars(expected) if vars(expected)[key] != vars(actual)[key]]
+    if fields:
+      mismatches += 1
+      print(f"{file}: {', '.join(f'{key} ({vars(expected)[key]} != {vars(actual)[key]})' for key in fields)}")
+    print(f"{file}: confidences {confidences}")
+  print(f"{mismatches} image(s) with mismatched fields")
+
+def testRankBackgrounds():
+  '''Test that the rank badge is found and the rank read on light, mid and dark backgrounds, and that the badge does not match a background without a rank'''
+  scoreAPI = ScoreAPI()
+  rng = np.random.default_rng(0)
+  window = searchWindows['ranks']
+
+  mismatches = 0
+  for background in [30, 90, 150, 210, 250]:
+    for template, rank in scoreAPI.templates['ranks']:
+      image = cv2.add(np.full((1080, 1920), background, np.uint8), rng.integers(0, 20, (1080, 1920), dtype=np.uint8))
+      h, w = template.shape[:2]
+      y, x = int(window[1] * 1080) + 200, int(window[0] * 1920) + 200
+      image[y:y+h, x:x+w] = template.image
+      frame = Frame(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+      actual = scoreAPI.getRank(frame)
+      score = frame.scores['rankBadge']
+      if actual != rank or score < RANK_BADGE_THRESHOLD:
+        mismatches += 1
+        print(f"background {background}: {rank} read as {actual}, badge score {score:.2f}")
+
+    image = cv2.add(np.full((1080, 1920), background, np.uint8), rng.integers(0, 20, (1080, 1920), dtype=np.uint8))
+    frame = Frame(cv2.cvtColor(image, cv2.COLOR_GRAY2BGR))
+    _, score, _ = scoreAPI.locate(frame, [scoreAPI.templates['rankBadge']], 'ranks', threshold=RANK_BADGE_THRESHOLD, binary=True)
+    if score >= RANK_BADGE_THRESHOLD:
+      mismatches += 1
+      print(f"background {background}: badge matched without a rank, score {score:.2f}")
+  print(f"{mismatches} mismatch(es)")
+
 def testImage(path):
   '''Test on a single image'''
   image = cv2.imread(path)
@@ -42,6 +104,38 @@ def testImage(path):
   plt.imshow(cv2.cvtColor(res, cv2.COLOR_BGR2RGB))
   plt.show()
 
+def shapelyImgDimensions(width, height):
+  '''The Shapely implementation that calculateImgDimensions replaced, kept to check it against'''
+  if width / height < 16 / 9:
+    w = width
+    h = int(w * 9 / 16)
+  else:
+    w = width
+    h = height
+
+  x = np.arange(450, 3000, 1)
+  y = 248.515 * np.log(0.413359 * x - 179.201) - 581.131
+  y2 = h/w * x
+
+  line1 = LineString(np.column_stack((x, y)))
+  line2 = LineString(np.column_stack((x, y2)))
+  intersection = line1.intersection(line2)
+
+  # get the second intersection point along the curve, since the order of geoms depends on the Shapely/GEOS version
+  p = max(intersection.geoms, key=lambda p: p.x)
+  return (int(p.x), int(p.x * (height / width)))
+
+def testImgDimensions():
+  '''Test that calculateImgDimensions matches the Shapely implementation on common phone and tablet resolutions'''
+  resolutions = [
+    (1280, 720), (1334, 750), (1600, 900), (1920, 1080), (2048, 1536), (2160, 1620), (2208, 1242),
+    (2224, 1668), (2266, 1488), (2340, 1080), (2360, 1640), (2388, 1668), (2400, 1080), (2436, 1125),
+    (2532, 1170), (2560, 1440), (2560, 1600), (2688, 1242), (2732, 2048), (2778, 1284), (2796, 1290),
+    (2960, 1440), (3040, 1440), (3200, 1440), (3840, 2160),
+  ]
+  mismatches = [(w, h) for w, h in resolutions if calculateImgDimensions(w, h) != shapelyImgDimensions(w, h)]
+  print(f"{len(resolutions) - len(mismatches)}/{len(resolutions)} resolution(s) match{f': mismatches {mismatches}' if mismatches else ''}")
+
 async def testDatabase():
   load_dotenv()
   userId = os.getenv('DISCORD_USER_ID')
@@ -57,6 +151,10 @@ def testBestdori():
   print(res)
 
 # testDir('live')
+# testImgDimensions()
+# testBatchOCR('live')
+# testTiered('live')
+# testRankBackgrounds()
 # testImage(f'{sys.path[0]} + /../testdata/IMG_0996.png')
 # testImage(f'{sys.path[0]} + /../testdata/BanG_Dream_2022-11-23-22-56-00.jpg')
 # asyncio.run(testDatabase())
@@ -0,0 +1,98 @@
+# Index of the fingerprints of song title crops, so that known titles are recognized without OCR
+import numpy as np
+import cv2
+
+import logging
+import os
+import threading
+
+from digits import foreground
+from functions import ASSETS_DIR
+from consts import TITLE_FINGERPRINT_SIZE, TITLE_MAX_DISTANCE, TITLE_WIDTH_TOLERANCE
+
+# Number of set bits of every byte
+POPCOUNT = np.array([bin(x).count('1') for x in range(256)], np.uint16)
+
+def titleFingerprint(roi):
+  '''Gets the fingerprint of a black and white title crop, or None if the crop is blank
+  \nThe fingerprint is the glyphs cropped to their horizontal extent and resized to TITLE_FINGERPRINT_SIZE bits, along with that width.
+  The crop keeps the full height of the ROI, which is fixed, since a speck above or below the glyphs would shift every row'''
+  if roi.size == 0:
+    return None
+  fg = foreground(roi)
+  xs = np.nonzero(fg.any(axis=0))[0]
+  if len(xs) == 0:
+    return None
+  box = fg[:, xs.min():xs.max()+1].astype(np.float32)
+  small = cv2.resize(box, TITLE_FINGERPRINT_SIZE, interpolation=cv2.INTER_AREA)
+  return np.packbits(small >= 0.5), int(xs.max() - xs.min() + 1)
+
+class TitleIndex:
+  '''Nearest neighbor index from title fingerprints to Bestdori song keys and names, kept in a file
+  \nThe bot adds the titles of the scores that users confirm, and the OCR workers reload the file whenever it changes'''
+  def __init__(self, path=f'{ASSETS_DIR}/titles.npz'):
+    self.path = path
+    self.lock = threading.Lock()
+    self.mtime = None
+    self.bits = np.zeros((0, np.prod(TITLE_FINGERPRINT_SIZE) // 8), np.uint8)
+    self.widths = np.zeros(0, np.int32)
+    self.keys, self.names = [], []
+    self.reload()
+
+  def reload(self):
+    '''Loads the index from its file if the file changed since it was last loaded'''
+    try:
+      mtime = os.path.getmtime(self.path)
+    except OSError:
+      return
+    if mtime == self.mtime:
+      return
+    try:
+      with np.load(self.path) as data:
+        bits, widths, keys, names = data['bits'], data['widths'], list(data['keys']), list(data['names'])
+    except Exception as e:
+      logging.warning(f'Title index: Unable to load {self.path}: {e}')
+      return
+    with self.lock:
+      self.bits, self.widths, self.keys, self.names, self.mtime = bits, widths, keys, names, mtime
+
+  def nearest(self, fingerprint):
+    '''Gets the index of the nearest title whose width is within TITLE_WIDTH_TOLERANCE and whose fingerprint is within TITLE_MAX_DISTANCE, or None'''
+    bits, width = fingerprint
+    with self.lock:
+      if len(self.keys) == 0:
+        return None
+      distances = POPCOUNT[self.bits ^ bits].sum(axis=1)
+      distances[np.abs(self.widths - width) > width * TITLE_WIDTH_TOLERANCE] = bits.size * 8
+      x = int(np.argmin(distances))
+      return x if distances[x] <= TITLE_MAX_DISTANCE * bits.size * 8 else None
+
+  def lookup(self, fingerprint):
+    '''Gets the (song key, song name) of a title fingerprint, or None if the title is not in the index'''
+    if fingerprint is None:
+      return None
+    self.reload()
+    x = self.nearest(fingerprint)
+    if x is None:
+      return None
+    with self.lock:
+      return str(self.keys[x]), str(self.names[x])
+
+  def add(self, fingerprint, key, name):
+    '''Adds the fingerprint of a confirmed title and saves the index, unless the title already matches it'''
+    if fingerprint is None or self.lookup(fingerprint) == (str(key), name):
+      return
+    bits, width = fingerprint
+    with self.lock:
+      self.bits = np.vstack((self.bits, bits[None]))
+      self.widths = np.append(self.widths, width)
+      self.keys.append(str(key))
+      self.names.append(name)
+    self.save()
+
+  def save(self):
+    with self.lock:
+      with open(f'{self.path}.tmp', 'wb') as f:
+        np.savez(f, bits=self.bits, widths=self.widths, keys=np.array(self.keys, dtype=str), names=np.array(self.names, dtype=str))
+      os.replace(f'{self.path}.tmp', self.path)
+      self.mtime = os.path.getmtime(self.path)
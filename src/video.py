@@ -0,0 +1,99 @@
+# Reading the result screens of screen recordings
+import os
+os.environ["OPENCV_LOG_LEVEL"]="SILENT"
+
+import cv2
+
+import argparse
+import json
+import sys
+
+from api import ScoreAPI
+from functions import rescaleImage
+from matching import Frame, matchBest, verifyMatch
+from result_cache import thumbnail, sameScreenshot
+from consts import searchWindows, MATCH_THRESHOLD, VIDEO_SAMPLE_RATE
+
+def anchorScore(api, frame, name, templates, window):
+  '''Gets the best match score of a group of templates, only searching around its cached location or inside its search window'''
+  anchor = api.layouts.get(frame.resolution, name)
+  if anchor is not None:
+    match = verifyMatch(frame, templates, anchor, fixed=False)
+    if match is not None:
+      return match[1]
+  # Never fall back to searching the whole frame, most frames are not result screens
+  return matchBest(frame, templates, searchWindows[window], threshold=-1, pyramid=True)[1]
+
+def isResultScreen(api, image):
+  '''Checks whether a video frame is a result screen by matching the score icon and the max combo templates'''
+  frame = Frame(rescaleImage(image), image.shape[:2])
+  return anchorScore(api, frame, 'scoreIcon', [api.templates['scoreIcon']], 'scoreIcon') >= MATCH_THRESHOLD and \
+    anchorScore(api, frame, 'maxCombo', list(api.templates['maxCombo']), 'maxCombo') >= MATCH_THRESHOLD
+
+def sampleFrames(path, rate=VIDEO_SAMPLE_RATE):
+  '''Lazily reads rate frames per second of a video, yielding the time in seconds and the frame'''
+  capture = cv2.VideoCapture(path)
+  if not capture.isOpened():
+    raise ValueError(f'Unable to open video {path}')
+  fps = capture.get(cv2.CAP_PROP_FPS) or 30
+  step = max(1, round(fps / rate))
+  try:
+    index = 0
+    while capture.grab():
+      # Only decode the frames that are sampled
+      if index % step == 0:
+        ok, image = capture.retrieve()
+        if ok:
+          yield index / fps, image
+      index += 1
+  finally:
+    capture.release()
+
+def resultKeyframes(api, frames):
+  '''Picks one keyframe per result screen from the sampled frames of a video
+  \nA result screen is only used once two samples in a row are the same, so that its animations are done. Later samples of the same result are skipped.
+  Only the last result and the pending keyframe are kept, so memory does not grow with the length of the video'''
+  current, candidate = None, None
+  for time, image in frames:
+    if not isResultScreen(api, image):
+      candidate = None
+      continue
+    thumb = thumbnail(image)
+    if current is not None and sameScreenshot(thumb, current):
+      continue
+    if candidate is not None and sameScreenshot(thumb, candidate[1]):
+      current, candidate = candidate[1], None
+      yield time, image
+    else:
+      candidate = (time, thumb, image)
+
+  # The video may end on a result screen that never had a second sample
+  if candidate is not None:
+    yield candidate[0], candidate[2]
+
+def readVideo(path, api=None, rate=VIDEO_SAMPLE_RATE):
+  '''Reads the song information of every result screen of a video
+  \nYields the time in seconds of each result along with its SongInfo and annotated image'''
+  api = api if api is not None else ScoreAPI()
+  for time, image in resultKeyframes(api, sampleFrames(path, rate)):
+    songInfo, res = api.getSongInfo(image)
+    yield time, songInfo, res
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Reads the song information of the result screens of a screen recording into JSON lines')
+  parser.add_argument('path', help='Video file to read')
+  parser.add_argument('-o', '--output', help='JSON lines file to write to, defaults to stdout')
+  parser.add_argument('-r', '--rate', type=float, default=VIDEO_SAMPLE_RATE, help='Frames per second to check for result screens')
+  parser.add_argument('--mode', default='cropped', help='Asset mode of the templates')
+  args = parser.parse_args()
+
+  output = open(args.output, 'w') if args.output else sys.stdout
+  try:
+    count = 0
+    for time, songInfo, _ in readVideo(args.path, ScoreAPI(args.mode), args.rate):
+      output.write(json.dumps({ 'file': args.path, 'time': round(time, 3), **songInfo.toDict() }) + '\n')
+      count += 1
+    print(f'{count} result screen(s)', file=sys.stderr)
+  finally:
+    if args.output:
+      output.close()